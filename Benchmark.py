@@ -0,0 +1,719 @@
+"""
+Throughput benchmark for Download.py against a local stand-in Salesforce org.
+
+A mock org runs in a separate process and serves query/queryMore pages, Bulk API 2.0 query jobs,
+and Attachment Body and ContentVersion VersionData blobs (full or HTTP Range) with configurable sizes, latency, error and throttling rates.
+It also stands in for an S3-compatible bucket (path-style, multipart upload), so --sink s3 can be measured offline,
+and for the OAuth token endpoint, expiring sessions after --session-ttl seconds so session renewal is exercised.
+Download.run_export then drives a real export against it (RecordStream, fetch_files or
+fetch_files_async, download_file, checkpoint and metadata CSV), and the run is checked and
+summarized as files/sec, MB/sec, p50/p99 per-file download latency (client-side), peak RSS and CPU.
+
+Options after "--" are passed to Download.py unchanged, e.g.
+
+    python Benchmark.py --files 5000 --min-size 4096 --max-size 1048576 --latency 0.05 -- -t 32 -e async
+"""
+import argparse
+import configparser
+import csv
+import glob
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+import requests
+from simple_salesforce.exceptions import SalesforceExpiredSession, SalesforceGeneralError
+
+import Download
+
+try:
+    import resource  # Not available on Windows; peak RSS is then reported as n/a
+except ImportError:
+    resource = None
+
+API_PATH = '/services/data/v59.0'
+STATS_PATH = '/_benchmark/stats'
+TOKEN_PATH = '/services/oauth2/token'
+INITIAL_SESSION_ID = '00DBENCHMARK!mock-session'
+BLOB_PATH_PATTERN = re.compile(r'^' + re.escape(API_PATH) + r'/sobjects/(Attachment|ContentVersion)/(\w+)/(Body|VersionData)$')
+S3_BUCKET = 'benchmark-bucket'
+S3_PATH_PATTERN = re.compile(r'^/' + S3_BUCKET + r'/(.+)$')
+RANGE_HEADER_PATTERN = re.compile(r'^bytes=(\d+)-(\d*)$')
+CURSOR_PATH_PATTERN = re.compile(r'^' + re.escape(API_PATH) + r'/query/01gBENCH-(\d+)$')
+BULK_JOB_PATH_PATTERN = re.compile(r'^' + re.escape(API_PATH) + r'/jobs/query/(750BENCH\d+)(/results)?$')
+
+BENCHMARK_QUERIES = {
+    'contentversion': "SELECT Id, Title, FileExtension, ContentSize, Checksum, VersionData FROM ContentVersion",
+    'attachment': "SELECT Id, Name, ContentType, BodyLength, Body FROM Attachment",
+}
+
+# Titles exercising the sanitizer: reserved characters, control characters, non-ASCII and double extensions
+SAMPLE_TITLES = [
+    'Quarterly Report',
+    'Q3 forecast: draft/final?',
+    'Contract <signed> "v2"',
+    'Résumé Übersicht',
+    'Invoice|2024*copy',
+    'Scan\t0001\r\n',
+    'presentation.pdf',
+    'Long title ' + 'x' * 120,
+]
+SAMPLE_EXTENSIONS = [('pdf', 'application/pdf'), ('docx', 'application/msword'), ('png', 'image/png'), ('txt', 'text/plain')]
+
+
+def record_id(salesforce_object, index):
+    """18-character, Id-ordered record Id for the index-th mock record."""
+    return ('00P' if salesforce_object == 'attachment' else '068') + f'{index:012d}' + 'AAA'
+
+
+def record_index(rec_id):
+    return int(rec_id[3:15])
+
+
+def blob_index(options, index):
+    """Index of the blob served for the index-th record: records share blobs when --distinct-blobs is set."""
+    return index % options['distinct_blobs'] if options['distinct_blobs'] else index
+
+
+def record_size(options, index):
+    """Deterministic blob size of the index-th record, so the client can verify every file."""
+    index = blob_index(options, index)
+    if options['max_size'] <= options['min_size']:
+        return options['min_size']
+    return random.Random(options['seed'] * 1000003 + index).randint(options['min_size'], options['max_size'])
+
+
+def blob_pieces(payload, index, size, start=0, end=None):
+    """Yields bytes start..end (inclusive) of the index-th blob: a slice of payload from index, wrapping to its start."""
+    end = size - 1 if end is None else end
+    offset = index % len(payload)
+    position = 0
+    while position <= end:
+        piece = payload[offset:offset + min(end + 1 - position, 65536)]
+        if position + len(piece) > start:
+            yield piece[max(start - position, 0):]
+        position += len(piece)
+        offset = offset + len(piece) if offset + len(piece) < len(payload) else 0
+
+
+def blob_checksum(payload, index, size):
+    """MD5 hex digest of the index-th blob, as ContentVersion.Checksum reports it."""
+    digest = hashlib.md5()
+    for piece in blob_pieces(payload, index, size):
+        digest.update(piece)
+    return digest.hexdigest()
+
+
+def build_record(options, index, payload=None):
+    """Mock record shaped like a REST query result for the benchmark SOQL of the configured object."""
+    rec_id = record_id(options['object'], index)
+    blob_id = record_id(options['object'], blob_index(options, index))
+    title = SAMPLE_TITLES[index % len(SAMPLE_TITLES)]
+    extension, content_type = SAMPLE_EXTENSIONS[index % len(SAMPLE_EXTENSIONS)]
+    size = record_size(options, index)
+    if options['object'] == 'attachment':
+        return {
+            'attributes': {'type': 'Attachment', 'url': f'{API_PATH}/sobjects/Attachment/{rec_id}'},
+            'Id': rec_id, 'Name': f'{title}.{extension}', 'ContentType': content_type, 'BodyLength': size,
+            'Body': f'{API_PATH}/sobjects/Attachment/{blob_id}/Body',
+        }
+    return {
+        'attributes': {'type': 'ContentVersion', 'url': f'{API_PATH}/sobjects/ContentVersion/{rec_id}'},
+        'Id': rec_id, 'Title': title, 'FileExtension': extension, 'ContentSize': size,
+        'Checksum': blob_checksum(payload, blob_index(options, index), size) if options['checksums'] and payload is not None else None,
+        'VersionData': f'{API_PATH}/sobjects/ContentVersion/{blob_id}/VersionData',
+    }
+
+
+class MockSalesforceState:
+    """Counters shared by the mock server's handler threads."""
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.random = random.Random(options['seed'])
+        self.payload = random.Random(options['seed']).randbytes(1048576)  # Blob bodies are slices of this block
+        self.status_counts = {}
+        self.bytes_sent = 0
+        self.query_requests = 0
+        self.bulk_jobs = {}  # Job Id -> selected field names
+        self.s3_objects = {}  # Key -> size of every object stored in the mock bucket
+        self.s3_uploads = {}  # Multipart upload Id -> (key, {part number: size})
+        self.sessions = {INITIAL_SESSION_ID: time.monotonic()}  # Session Id -> issue time
+        self.logins = 0
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+    def count(self, status, bytes_sent=0):
+        with self.lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            self.bytes_sent += bytes_sent
+
+
+class MockSalesforceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so connection pooling is measured like against a real org
+    server_version = 'MockSalesforce/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        """Checks the OAuth/Bearer session, answering 401 INVALID_SESSION_ID (as Salesforce does) if it is unknown or older than --session-ttl."""
+        state = self.server.state
+        scheme, _, session_id = self.headers.get('Authorization', '').partition(' ')
+        with state.lock:
+            issued = state.sessions.get(session_id) if scheme in ('OAuth', 'Bearer') else None
+        ttl = state.options['session_ttl']
+        if issued is not None and (not ttl or time.monotonic() - issued < ttl):
+            return True
+        state.count(401)
+        self.send_json(401, [{'message': 'Session expired or invalid', 'errorCode': 'INVALID_SESSION_ID'}])
+        return False
+
+    def serve_login(self):
+        """OAuth token endpoint: every login issues a new session Id."""
+        state = self.server.state
+        with state.lock:
+            state.logins += 1
+            session_id = f'00DBENCHMARK!session-{state.logins}'
+            state.sessions[session_id] = time.monotonic()
+        self.send_json(200, {'access_token': session_id, 'instance_url': f'http://{self.headers.get("Host")}', 'token_type': 'Bearer'})
+
+    def injected_failure(self):
+        """Returns (status, headers) of a randomly injected 429 or 503, or None to serve normally."""
+        options = self.server.state.options
+        draw = self.server.state.draw()
+        if draw < options['throttle_rate']:
+            return 429, {'Retry-After': str(options['retry_after'])}
+        if draw < options['throttle_rate'] + options['error_rate']:
+            return 503, {}
+        return None
+
+    def do_GET(self):
+        state = self.server.state
+        url = urlsplit(self.path)
+        if url.path == STATS_PATH:
+            with state.lock:
+                self.send_json(200, {'status_counts': state.status_counts,
+                                     'bytes_sent': state.bytes_sent, 'query_requests': state.query_requests,
+                                     's3_objects': state.s3_objects, 'logins': state.logins})
+            return
+        if not self.authorized():
+            return
+
+        blob_match = BLOB_PATH_PATTERN.match(url.path)
+        if blob_match:
+            self.serve_blob(record_index(blob_match.group(2)))
+        elif url.path == f'{API_PATH}/query' or url.path == f'{API_PATH}/query/':
+            self.serve_query_page(0)
+        elif CURSOR_PATH_PATTERN.match(url.path):
+            self.serve_query_page(int(CURSOR_PATH_PATTERN.match(url.path).group(1)))
+        elif BULK_JOB_PATH_PATTERN.match(url.path):
+            job_match = BULK_JOB_PATH_PATTERN.match(url.path)
+            if job_match.group(2):
+                params = parse_qs(url.query)
+                self.serve_bulk_results(job_match.group(1), int(params.get('locator', ['0'])[0]), int(params.get('maxRecords', ['50000'])[0]))
+            else:
+                self.send_json(200, {'id': job_match.group(1), 'operation': 'query', 'state': 'JobComplete', 'numberRecordsProcessed': state.options['files']})
+        else:
+            self.send_json(404, [{'message': 'The requested resource does not exist', 'errorCode': 'NOT_FOUND'}])
+
+    def send_s3(self, status, body=b'', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        """S3 HeadObject."""
+        s3_match = S3_PATH_PATTERN.match(urlsplit(self.path).path)
+        size = self.server.state.s3_objects.get(unquote(s3_match.group(1))) if s3_match else None
+        if size is None:
+            self.send_s3(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.send_header('ETag', '"benchmark"')
+        self.end_headers()
+
+    def do_PUT(self):
+        """S3 PutObject and UploadPart. Only sizes are kept; the bodies are discarded."""
+        state = self.server.state
+        url = urlsplit(self.path)
+        s3_match = S3_PATH_PATTERN.match(url.path)
+        if not s3_match:
+            self.send_s3(404)
+            return
+        key, params = unquote(s3_match.group(1)), parse_qs(url.query)
+        size = int(self.headers.get('Content-Length', 0))
+        remaining = size
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 1048576)))
+        with state.lock:
+            if 'uploadId' in params:
+                upload = state.s3_uploads.get(params['uploadId'][0])
+                if upload is None:
+                    self.send_s3(404, b'<Error><Code>NoSuchUpload</Code></Error>')
+                    return
+                upload[1][int(params['partNumber'][0])] = size
+            else:
+                state.s3_objects[key] = size
+        self.send_s3(200, headers={'ETag': f'"{key}-{size}"'})
+
+    def do_DELETE(self):
+        """S3 AbortMultipartUpload."""
+        params = parse_qs(urlsplit(self.path).query)
+        with self.server.state.lock:
+            self.server.state.s3_uploads.pop(params.get('uploadId', [''])[0], None)
+        self.send_s3(204)
+
+    def serve_s3_post(self, key, params):
+        """S3 CreateMultipartUpload (?uploads) and CompleteMultipartUpload (?uploadId=)."""
+        state = self.server.state
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with state.lock:
+            if 'uploads' in params:
+                upload_id = f'upload-{len(state.s3_uploads)}-{time.perf_counter_ns()}'
+                state.s3_uploads[upload_id] = (key, {})
+                result = f'<InitiateMultipartUploadResult><Bucket>{S3_BUCKET}</Bucket><Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'
+            else:
+                upload = state.s3_uploads.pop(params.get('uploadId', [''])[0], None)
+                if upload is None:
+                    self.send_s3(404, b'<Error><Code>NoSuchUpload</Code></Error>')
+                    return
+                state.s3_objects[key] = sum(upload[1].values())
+                result = f'<CompleteMultipartUploadResult><Bucket>{S3_BUCKET}</Bucket><Key>{escape(key)}</Key><ETag>"{escape(key)}"</ETag></CompleteMultipartUploadResult>'
+        self.send_s3(200, ('<?xml version="1.0" encoding="UTF-8"?>' + result).encode('utf-8'), {'Content-Type': 'application/xml'})
+
+    def do_POST(self):
+        """Bulk API 2.0 query job creation. The job completes immediately; only the SELECT list is honored."""
+        state = self.server.state
+        url = urlsplit(self.path)
+        s3_match = S3_PATH_PATTERN.match(url.path)
+        if s3_match:
+            self.serve_s3_post(unquote(s3_match.group(1)), parse_qs(url.query, keep_blank_values=True))
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if url.path == TOKEN_PATH:
+            self.serve_login()
+            return
+        if not self.authorized():
+            return
+        if urlsplit(self.path).path != f'{API_PATH}/jobs/query' or request.get('operation') != 'query':
+            self.send_json(404, [{'message': 'The requested resource does not exist', 'errorCode': 'NOT_FOUND'}])
+            return
+        fields = [field.strip() for field in re.search(r'SELECT\s+(.*?)\s+FROM\s', request['query'], re.IGNORECASE | re.DOTALL).group(1).split(',')]
+        if any(field.split('.')[-1].lower() in ('body', 'versiondata') for field in fields):
+            self.send_json(400, [{'message': 'Selecting compound data not supported in Bulk Query', 'errorCode': 'INVALIDJOB'}])
+            return
+        with state.lock:
+            state.query_requests += 1
+            job_id = f'750BENCH{len(state.bulk_jobs):07d}'
+            state.bulk_jobs[job_id] = fields
+        self.send_json(200, {'id': job_id, 'operation': 'query', 'state': 'UploadComplete'})
+
+    def serve_bulk_results(self, job_id, offset, max_records):
+        state = self.server.state
+        options = state.options
+        fields = state.bulk_jobs.get(job_id)
+        if fields is None:
+            self.send_json(404, [{'message': 'Job not found', 'errorCode': 'NOT_FOUND'}])
+            return
+        with state.lock:
+            state.query_requests += 1
+        end = min(offset + max_records, options['files'])
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(fields)
+        for index in range(offset, end):
+            record = build_record(options, index, state.payload)
+            writer.writerow(['' if record.get(field) is None else record.get(field) for field in fields])
+        body = buffer.getvalue().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Sforce-Locator', str(end) if end < options['files'] else 'null')
+        self.send_header('Sforce-NumberOfRecords', str(end - offset))
+        self.end_headers()
+        if options['query_errors'] and self.server.state.draw() < options['error_rate']:
+            self.wfile.write(body[:len(body) // 2])  # Drop the connection halfway through the page
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def serve_query_page(self, offset):
+        state = self.server.state
+        options = state.options
+        with state.lock:
+            state.query_requests += 1
+        if options['query_errors']:
+            failure = self.injected_failure()
+            if failure and failure[0] == 429:
+                # The REST API refuses a throttled query with 403 REQUEST_LIMIT_EXCEEDED
+                self.send_json(403, [{'message': 'Injected failure', 'errorCode': 'REQUEST_LIMIT_EXCEEDED'}], failure[1])
+                return
+            if failure:
+                self.send_json(failure[0], [{'message': 'Injected failure', 'errorCode': 'SERVER_UNAVAILABLE'}], failure[1])
+                return
+        end = min(offset + options['page_size'], options['files'])
+        page = {'totalSize': options['files'], 'done': end >= options['files'],
+                'records': [build_record(options, index, state.payload) for index in range(offset, end)]}
+        if not page['done']:
+            page['nextRecordsUrl'] = f'{API_PATH}/query/01gBENCH-{end}'
+        self.send_json(200, page)
+
+    def serve_blob(self, index):
+        state = self.server.state
+        options = state.options
+        if options['latency']:
+            time.sleep(options['latency'])
+        failure = self.injected_failure()
+        if failure:
+            self.send_json(failure[0], [{'message': 'Injected failure', 'errorCode': 'REQUEST_LIMIT_EXCEEDED' if failure[0] == 429 else 'SERVER_UNAVAILABLE'}], failure[1])
+            state.count(failure[0])
+            return
+        if index >= options['files']:
+            self.send_json(404, [{'message': 'The requested resource does not exist', 'errorCode': 'NOT_FOUND'}])
+            state.count(404)
+            return
+
+        size = record_size(options, index)
+        byte_range = RANGE_HEADER_PATTERN.match(self.headers.get('Range', ''))
+        start, end = (0, size - 1) if not byte_range else (int(byte_range.group(1)), min(int(byte_range.group(2) or size - 1), size - 1))
+        if start > end:
+            self.send_json(416, [{'message': 'Requested range not satisfiable', 'errorCode': 'INVALID_RANGE'}], {'Content-Range': f'bytes */{size}'})
+            state.count(416)
+            return
+        status = 206 if byte_range else 200
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        for piece in blob_pieces(state.payload, index, size, start, end):
+            self.wfile.write(piece)
+        state.count(status, end - start + 1)
+
+
+class MockSalesforceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        """Ignores connections the client reset or closed (dropped keep-alives, cancelled downloads); prints anything else."""
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def serve_mock_salesforce(options, port_queue):
+    """Process entry point of the mock org. Reports the bound port through port_queue, then serves forever."""
+    server = MockSalesforceServer(('127.0.0.1', options['port']), MockSalesforceHandler)
+    server.state = MockSalesforceState(options)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class MockSalesforceClient:
+    """
+    Minimal stand-in for simple_salesforce.Salesforce talking plain http to the mock org. Provides
+    what Download.py uses: session_id, headers, sf_instance, sf_version, instance_url, query and query_more.
+    """
+
+    def __init__(self, base_url, session_id=INITIAL_SESSION_ID):
+        self.instance_url = base_url
+        self.sf_instance = urlsplit(base_url).netloc
+        self.session_id = session_id
+        self.sf_version = API_PATH.rsplit('/v', 1)[1]
+        self.headers = {'Authorization': 'Bearer ' + session_id}
+        self.session = requests.Session()
+
+    def _get(self, path, params=None):
+        response = self.session.get(self.instance_url + path, params=params, headers=self.headers, timeout=60)
+        if response.status_code == 401:
+            raise SalesforceExpiredSession(response.url, response.status_code, 'query', response.content)
+        if response.status_code >= 300:
+            raise SalesforceGeneralError(response.url, response.status_code, 'query', response.content)
+        return response.json()
+
+    def query(self, query, include_deleted=False, **kwargs):
+        return self._get(f'{API_PATH}/query/', params={'q': query})
+
+    def query_more(self, next_records_identifier, identifier_is_url=False, include_deleted=False, **kwargs):
+        if identifier_is_url:
+            return self._get(next_records_identifier)
+        return self._get(f'{API_PATH}/query/{next_records_identifier}')
+
+
+class MockSessionManager(Download.SessionManager):
+    """Download.SessionManager logging in at the mock org's token endpoint instead of SalesforceLogin."""
+
+    def _login(self):
+        response = requests.post(self.sf.instance_url + TOKEN_PATH, timeout=60)
+        response.raise_for_status()
+        return response.json()['access_token'], self.sf.sf_instance
+
+
+class LatencyRecordingProgress(Download.ProgressTracker):
+    """Download.ProgressTracker that also keeps every per-file latency, for exact percentiles (the histogram starts at 100 ms)."""
+
+    def __init__(self, label=''):
+        super().__init__(label)
+        self.latencies = []
+
+    def observe_latency(self, seconds):
+        super().observe_latency(seconds)
+        self.latencies.append(seconds)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1048576 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+def stored_sizes(output_directory, s3_objects):
+    """Sizes of files stored outside loose paths, by the location Download.py records: archive members and S3 objects."""
+    sizes = {f's3://{S3_BUCKET}/{key}': size for key, size in s3_objects.items()}
+    for path in glob.glob(os.path.join(glob.escape(output_directory), 'files*_[0-9]*.zip')):
+        with zipfile.ZipFile(path) as archive:
+            sizes.update((os.path.join(path, info.filename), info.file_size) for info in archive.infolist())
+    for path in glob.glob(os.path.join(glob.escape(output_directory), 'files*_[0-9]*.tar')):
+        with tarfile.open(path) as archive:
+            sizes.update((os.path.join(path, info.name), info.size) for info in archive.getmembers())
+    return sizes
+
+
+def verify_export(options, output_directory, checkpoint_path, results_path, s3_objects=None):
+    """
+    Checks the export against what the mock org served: every Success row has a file (loose, archive
+    member or S3 object) of the expected size under a distinct, sanitized name, and the metadata CSV
+    has one row per record.
+
+    Returns:
+        tuple: (status_counts, bytes_downloaded, problems)
+    """
+    problems = []
+    status_counts = {}
+    bytes_downloaded = 0
+    seen_paths = set()  # Paths written by a record; reference rows point at one of these, in any row order
+    referenced_paths = {}
+    sizes = stored_sizes(output_directory, s3_objects or {})
+    connection = sqlite3.connect(checkpoint_path)
+    try:
+        rows = connection.execute('SELECT Id, Status, FilePath, Bytes FROM checkpoint').fetchall()
+    finally:
+        connection.close()
+    for rec_id, status, filepath, bytes_written in rows:
+        status_counts[status] = status_counts.get(status, 0) + 1
+        if not status.startswith('Success'):
+            continue
+        bytes_downloaded += bytes_written or 0
+        expected = record_size(options, record_index(rec_id))
+        stored = sizes.get(filepath, os.path.getsize(filepath) if os.path.isfile(filepath) else None)
+        if stored != expected:
+            problems.append(f'{rec_id}: {filepath} missing or not {expected} bytes')
+        if status == 'Success (Duplicate Reference)':
+            referenced_paths[filepath] = rec_id
+        elif filepath in seen_paths:
+            problems.append(f'{rec_id}: {filepath} written by more than one record')
+        else:
+            seen_paths.add(filepath)
+        name = filepath.split('/', 3)[3] if filepath.startswith('s3://') else os.path.relpath(filepath, output_directory)
+        if Download.ILLEGAL_CHAR_CLASS_PATTERN.search(name.replace(os.sep, '').replace('/', '')):
+            problems.append(f'{rec_id}: unsanitized filename {filepath}')
+    for filepath, rec_id in referenced_paths.items():
+        if filepath not in seen_paths:
+            problems.append(f'{rec_id}: references {filepath}, which no record wrote')
+    if len(rows) != options['files']:
+        problems.append(f'checkpoint has {len(rows)} records, expected {options["files"]}')
+
+    with open(results_path, 'r', encoding='utf-8', newline='') as f_csv:
+        csv_rows = sum(1 for _ in csv.reader(f_csv)) - 1
+    if csv_rows != options['files']:
+        problems.append(f'{os.path.basename(results_path)} has {csv_rows} rows, expected {options["files"]}')
+    return status_counts, bytes_downloaded, problems
+
+
+def run_benchmark(options, download_argv, config_path=None, output_directory=None):
+    """Starts the mock org, runs one export against it and returns the measured results as a dict."""
+    context = multiprocessing.get_context('spawn')
+    port_queue = context.Queue()
+    server = context.Process(target=serve_mock_salesforce, args=(options, port_queue), daemon=True)
+    server.start()
+    base_url = f'http://127.0.0.1:{port_queue.get(timeout=30)}'
+    keep_output = output_directory is not None
+    output_directory = output_directory or tempfile.mkdtemp(prefix='sf_benchmark_')
+    try:
+        config = configparser.ConfigParser()
+        config['salesforce'] = {'batch_size': '1000', 'loglevel': 'WARNING', 'retry_base_delay': '0.05',
+                                'retry_max_delay': '2', 'circuit_breaker_cooldown': '1'}
+        if config_path:
+            config.read(config_path)  # Benchmark production tuning; output_dir and the bucket always point at the scratch directory and mock org
+        config['salesforce'].update({'output_dir': output_directory, 's3_bucket': S3_BUCKET, 's3_prefix': '', 's3_endpoint_url': base_url,
+                                     's3_region': 'us-east-1', 's3_access_key': 'benchmark', 's3_secret_key': 'benchmark'})
+        os.makedirs(output_directory, exist_ok=True)
+        results_path = os.path.join(output_directory, 'files_metadata.csv')
+        checkpoint_path = os.path.join(output_directory, 'download_checkpoint.db')
+
+        query = BENCHMARK_QUERIES[options['object']]
+        args = Download.build_arg_parser().parse_args(['-q', query, '-m', '1,2,3', '-f', '{1}_{2}.{3}'] + download_argv)
+        sf = MockSalesforceClient(base_url)
+        auth = MockSessionManager(sf, login={'username': 'benchmark'}, max_age=config.getfloat('salesforce', 'session_max_age', fallback=0))
+
+        Download._created_directories.clear()
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        progress = LatencyRecordingProgress()
+        Download.run_export(sf, args, config, args.query, results_path, checkpoint_path, auth=auth, progress=progress)
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+        print()
+
+        server_stats = sf.session.get(base_url + STATS_PATH, timeout=60).json()
+        status_counts, bytes_downloaded, problems = verify_export(options, output_directory, checkpoint_path, results_path, server_stats['s3_objects'])
+        latencies = sorted(progress.latencies)
+        files_ok = sum(count for status, count in status_counts.items() if status.startswith('Success'))
+        return {
+            'files': options['files'],
+            'engine': args.engine,
+            'threads': args.threadcount,
+            'wall_seconds': round(wall, 3),
+            'files_per_second': round(files_ok / wall, 2),
+            'mb_per_second': round(bytes_downloaded / wall / 1048576, 2),
+            'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            'peak_rss_mb': round(peak_rss_mb(), 1) if resource else None,
+            'cpu_seconds': round(cpu, 2),
+            'cpu_percent': round(100 * cpu / wall, 1),
+            'statuses': status_counts,
+            'http_statuses': server_stats['status_counts'],
+            'query_requests': server_stats['query_requests'],
+            'logins': server_stats['logins'],
+            'problems': problems,
+        }
+    finally:
+        server.terminate()
+        server.join()
+        if not keep_output:
+            shutil.rmtree(output_directory, ignore_errors=True)
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns the regressions of results against a baseline run, beyond the given relative tolerance."""
+    regressions = []
+    for key in ('files_per_second', 'mb_per_second'):
+        if baseline.get(key) and results[key] < baseline[key] * (1 - tolerance):
+            regressions.append(f'{key} {results[key]} < baseline {baseline[key]}')
+    for key in ('latency_p99_ms', 'peak_rss_mb', 'cpu_seconds'):
+        if baseline.get(key) and results.get(key) and results[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f'{key} {results[key]} > baseline {baseline[key]}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Download.py against a local mock Salesforce org. Arguments after "--" are passed to Download.py (e.g. -- -t 32 -e async).')
+    parser.add_argument('--files', type=int, default=2000, help='Number of records served by the mock org (default: 2000)')
+    parser.add_argument('--object', choices=sorted(BENCHMARK_QUERIES), default='contentversion', help='Object queried: ContentVersion VersionData or Attachment Body blobs (default: contentversion)')
+    parser.add_argument('--min-size', type=int, default=65536, help='Smallest blob in bytes (default: 65536)')
+    parser.add_argument('--max-size', type=int, default=None, help='Largest blob in bytes; sizes are drawn uniformly between min and max (default: min-size)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the mock org waits before answering each blob request (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of blob requests answered with 503 (default: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of blob requests answered with 429 REQUEST_LIMIT_EXCEEDED (default: 0)')
+    parser.add_argument('--retry-after', type=float, default=0, help='Retry-After seconds sent with each 429 (default: 0)')
+    parser.add_argument('--query-errors', action='store_true', help='Also inject the error and throttle rates into query/queryMore pages, and cut off Bulk result pages at the error rate')
+    parser.add_argument('--checksums', action='store_true', help='Serve the MD5 Checksum of every ContentVersion so downloads are verified against it (costs mock-server CPU)')
+    parser.add_argument('--page-size', type=int, default=2000, help='Records per query/queryMore page (default: 2000)')
+    parser.add_argument('--distinct-blobs', type=int, default=0, help='Serve only this many distinct blobs, shared round-robin by the records, to exercise --dedup (default: 0, one blob per record)')
+    parser.add_argument('--session-ttl', type=float, default=0, help='Seconds after which the mock org rejects a session with 401 INVALID_SESSION_ID, so it has to be renewed (default: 0, never)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for blob sizes and injected failures (default: 1)')
+    parser.add_argument('--port', type=int, default=0, help='Port of the mock org (default: any free port)')
+    parser.add_argument('--config', default=None, help='ini file whose [salesforce] tuning (batch_size, chunk_size, max_retries, ...) is used for the run')
+    parser.add_argument('--output', default=None, help='Keep the exported files in this directory (default: a temporary directory, removed afterwards)')
+    parser.add_argument('--json', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run; exit with status 1 if this run regresses beyond --tolerance')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression against --baseline (default: 0.2)')
+    parser.add_argument('--loglevel', default='WARNING', help='Log level of the export (default: WARNING)')
+    argv = sys.argv[1:]
+    download_argv = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.getLevelName(args.loglevel.upper()))
+    options = {
+        'files': args.files, 'object': args.object, 'min_size': args.min_size,
+        'max_size': args.max_size if args.max_size is not None else args.min_size,
+        'latency': args.latency, 'error_rate': args.error_rate, 'throttle_rate': args.throttle_rate,
+        'retry_after': args.retry_after, 'query_errors': args.query_errors, 'page_size': args.page_size, 'checksums': args.checksums,
+        'distinct_blobs': args.distinct_blobs, 'session_ttl': args.session_ttl, 'seed': args.seed, 'port': args.port,
+    }
+    results = run_benchmark(options, download_argv, args.config, args.output)
+
+    print(f"Files:        {results['files']} (engine: {results['engine']}, threadcount: {results['threads']})")
+    print(f"Wall time:    {results['wall_seconds']:.2f}s")
+    print(f"Throughput:   {results['files_per_second']:.1f} files/s, {results['mb_per_second']:.2f} MB/s")
+    print(f"Latency:      p50 {results['latency_p50_ms']} ms, p99 {results['latency_p99_ms']} ms (client-side, per downloaded file including retries)")
+    print(f"Peak RSS:     {results['peak_rss_mb'] if results['peak_rss_mb'] is not None else 'n/a'} MB")
+    print(f"CPU:          {results['cpu_seconds']:.2f}s ({results['cpu_percent']:.0f}% of one core)")
+    print(f"Statuses:     {results['statuses']}")
+    print(f"HTTP:         {results['http_statuses']}, {results['query_requests']} query pages, {results['logins']} session renewals")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f_json:
+            json.dump(results, f_json, indent=2)
+
+    failed = False
+    for problem in results['problems'][:20]:
+        logging.error(f"Verification failed: {problem}")
+    if results['problems']:
+        logging.error(f"{len(results['problems'])} verification problems.")
+        failed = True
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f_baseline:
+            regressions = compare_to_baseline(results, json.load(f_baseline), args.tolerance)
+        for regression in regressions:
+            logging.error(f"Regression: {regression}")
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 import concurrent.futures  
-from simple_salesforce import Salesforce  
+from simple_salesforce import Salesforce, SalesforceLogin  
+from simple_salesforce.exceptions import SalesforceError, SalesforceGeneralError, SalesforceExpiredSession, SalesforceRefusedRequest
 import requests  
+import urllib3
+import asyncio  
 import os  
 import csv  
 import re  
@@ -9,64 +12,180 @@ import threading
 import argparse  
 import configparser  
 import getpass  # Required for masking password and token inputs
+import time
+import queue
+import collections
+import itertools
+import heapq
+import sqlite3
+import bisect
+import random
+import json
+import io
+import hashlib
+import glob
+import tempfile
+import zipfile
+import tarfile
+import shutil
+import multiprocessing
+import cProfile
+import pstats
+import http.server
+from datetime import datetime, timezone
+try:  
+    import aiohttp  # Optional: only needed for --engine async  
+except ImportError:  
+    aiohttp = None  
+try:  
+    import boto3  # Optional: only needed for --sink s3  
+    import botocore.config  
+    import botocore.exceptions  
+except ImportError:  
+    boto3 = None  
   
-csv_writer_lock = threading.Lock()  
 status_lock = threading.Lock()  
 
-def load_id_list_from_csv(csv_filepath):  
-    """Loads IDs from a CSV file (first column only). Returns a set of IDs."""  
-    id_set = set()  
-    try:  
-        with open(csv_filepath, 'r', encoding='utf-8-sig') as csvfile:  
-            reader = csv.reader(csvfile)  
-            for row in reader:  
-                if row:  # ensure row not empty  
-                    id_set.add(row[0].strip())  
-        logging.info(f"Loaded {len(id_set)} IDs from {csv_filepath}")  
-    except Exception as e:  
-        logging.error(f"Failed to load IDs from CSV: {e}")  
-        exit(1)  
-    return id_set  
+# Candidate paths holding the version fingerprint used for deduplication and incremental sync  
+CHECKSUM_FIELD_PATHS = ['Checksum', 'LatestPublishedVersion.Checksum', 'ContentDocument.LatestPublishedVersion.Checksum']  
+MODSTAMP_FIELD_PATHS = ['SystemModstamp', 'LatestPublishedVersion.SystemModstamp', 'ContentDocument.LatestPublishedVersion.SystemModstamp']  
+
+# HTTP statuses worth retrying: timeouts, throttling (429) and transient server-side failures  
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}  
+
+# Candidate paths holding the expected file size, per object type the SOQL may be written against
+SIZE_FIELD_PATHS = ['BodyLength', 'ContentSize', 'LatestPublishedVersion.ContentSize', 'ContentDocument.LatestPublishedVersion.ContentSize']
+
+# Candidate paths holding the VersionData URL (ContentDocument, ContentDocumentLink, ContentVersion)  
+VERSION_DATA_FIELD_PATHS = ['LatestPublishedVersion.VersionData', 'ContentDocument.LatestPublishedVersion.VersionData', 'VersionData']  
+
+def iter_ids_from_csv(csv_filepath):  
+    """Streams IDs from the first column of a CSV file, one row at a time, so the file is never loaded whole."""  
+    with open(csv_filepath, 'r', encoding='utf-8-sig', newline='') as csvfile:  
+        for row in csv.reader(csvfile):  
+            if row and row[0].strip():  # ensure row not empty  
+                yield row[0].strip()  
+
+
+def normalize_id(record_id):  
+    """15-character (case-sensitive) form of a Salesforce Id, so 15- and 18-character Ids compare equal."""  
+    return record_id[:15] if record_id else record_id  
+
+
+class IdIndex:  
+    """  
+    Membership index of the [RecordFiltering] ID list, built by streaming the CSV and compared in the  
+    15-character Id form. Up to memory_limit Ids are held in a set; a longer list is moved into a  
+    temporary SQLite table in spill_directory (WITHOUT ROWID, so each Id is stored once, in the  
+    primary key B-tree) and looked up there, so multi-million-row lists never have to fit in memory.  
+    Safe to share between threads.  
+    """  
+
+    def __init__(self, csv_filepath, memory_limit=1000000, spill_directory=None):  
+        self.ids = set()  
+        self.db_path = None  
+        self._conn = None  
+        self._lock = threading.Lock()  
+        batch = []  
+        for record_id in iter_ids_from_csv(csv_filepath):  
+            record_id = normalize_id(record_id)  
+            if self._conn is None:  
+                self.ids.add(record_id)  
+                if len(self.ids) > memory_limit:  
+                    self._spill(spill_directory)  
+            else:  
+                batch.append((record_id,))  
+                if len(batch) >= 10000:  
+                    self._insert(batch)  
+                    batch = []  
+        if batch:  
+            self._insert(batch)  
+        self.count = len(self.ids) if self._conn is None else self._conn.execute('SELECT COUNT(*) FROM ids').fetchone()[0]  
+        logging.info(f"Loaded {self.count} IDs from {csv_filepath}" + (f" into {self.db_path}" if self.db_path else ''))  
+
+    def _spill(self, directory):  
+        handle, self.db_path = tempfile.mkstemp(prefix='id_filter_', suffix='.db', dir=directory)  
+        os.close(handle)  
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)  
+        self._conn.execute('PRAGMA journal_mode=OFF')  
+        self._conn.execute('PRAGMA synchronous=OFF')  
+        self._conn.execute('CREATE TABLE ids (Id TEXT PRIMARY KEY) WITHOUT ROWID')  
+        self._insert([(record_id,) for record_id in self.ids])  
+        self.ids = set()  
+
+    def _insert(self, rows):  
+        self._conn.executemany('INSERT OR IGNORE INTO ids VALUES (?)', rows)  
+        self._conn.commit()  
+
+    def __len__(self):  
+        return self.count  
+
+    def __contains__(self, record_id):  
+        if not record_id:  
+            return False  
+        if self._conn is None:  
+            return normalize_id(record_id) in self.ids  
+        with self._lock:  
+            return self._conn.execute('SELECT 1 FROM ids WHERE Id = ?', (normalize_id(record_id),)).fetchone() is not None  
+
+    def __iter__(self):  
+        """Ids in sorted order."""  
+        if self._conn is None:  
+            return iter(sorted(self.ids))  
+        with self._lock:  
+            return iter([row[0] for row in self._conn.execute('SELECT Id FROM ids ORDER BY Id')])  
+
+    def close(self):  
+        if self._conn is not None:  
+            self._conn.close()  
+            self._conn = None  
+            os.remove(self.db_path)  
+
 
-  
 # Define illegal characters explicitly (control chars, reserved punctuation, non-ASCII)  
 ILLEGAL_CHARS_PATTERN = re.compile(r'[\x00-\x1F<>:"/\\|?*]|[^\x00-\x7F]')    
+# Same set as ILLEGAL_CHARS_PATTERN folded into one character class, which the regex engine scans much faster  
+ILLEGAL_CHAR_CLASS_PATTERN = re.compile(r'[\x00-\x1F<>:"/\\|?*\x80-\U0010FFFF]')  
+# Complement of ILLEGAL_CHARS_PATTERN, used to blank out legal characters when building the mask  
+LEGAL_CHARS_PATTERN = re.compile(r'[^\x00-\x1F<>:"/\\|?*\x80-\U0010FFFF]')  
   
-def sanitize_with_mask(original_str, replace_with=' '):     #<<<< See note below.
+def sanitize_with_mask(original_str, replace_with=' ', with_mask=True):     #<<<< See note below.
     """  
     Removes illegal characters from original_str and returns both sanitized string and illegal mask.  
         Reserved Characters for Filenames/Paths (Commonly Problematic): \x00-\x1F: Removes all control characters (ASCII 0–31).
         Characters Problematic for CSV Formatting: <>:"|?*:/ Removes reserved filename characters (Windows/Linux issues).
     Illegal mask helps identify removed characters for debugging purposes.  
+    Clean strings (the vast majority) are detected with a single regex search and returned as-is;  
+    others go through one compiled re.sub. Output is identical to checking ILLEGAL_CHARS_PATTERN  
+    character by character.  
       
     Args:  
         original_str (str): Original input string to sanitize.  
         replace_with (str): Character to replace illegal chars with ('' to remove completely).  
+        with_mask (bool): Build the illegal mask (returned as None otherwise).  
       
     Returns:  
         sanitized (str): The sanitized string.  
         illegal_mask (str): A mask showing removed characters and their positions.  
     """  
-    sanitized = []  
-    illegal_mask = []  
-    for c in original_str:  
-        if ILLEGAL_CHARS_PATTERN.match(c):  
-            sanitized.append(replace_with)  # Replace or remove illegal char  
-            illegal_mask.append(c)          # Record illegal char in mask  
-            # Optional debug print line (uncomment if needed):  
-            # print(f"Removed '{c}' (ASCII: {ord(c)}) from input.")  
-        else:  
-            sanitized.append(c)             # Keep legal char  
-            illegal_mask.append(' ')        # Placeholder for legal char  
-    return ''.join(sanitized), ''.join(illegal_mask)  
+    if ILLEGAL_CHAR_CLASS_PATTERN.search(original_str) is None:  
+        # Nothing to replace, so every position of the mask is a placeholder  
+        return original_str, (' ' * len(original_str) if with_mask else None)  
+    sanitized = ILLEGAL_CHAR_CLASS_PATTERN.sub(replace_with.replace('\\', '\\\\'), original_str)  
+    illegal_mask = LEGAL_CHARS_PATTERN.sub(' ', original_str) if with_mask else None  
+    return sanitized, illegal_mask  
   
   
 def split_into_batches(items, batch_size):  
     """  
-    Yields successive batches of items.  
+    Yields successive batches of items. Works on any iterable, including streams of unknown length.  
     """  
-    for i in range(0, len(items), batch_size):  
-        yield items[i:i + batch_size]  
+    iterator = iter(items)  
+    while True:  
+        batch = list(itertools.islice(iterator, batch_size))  
+        if not batch:  
+            return  
+        yield batch  
   
   
 def remove_double_extension(filename):  
@@ -88,7 +207,21 @@ def remove_double_extension(filename):
     return filename  
   
   
-def create_filename(title, file_extension, output_directory, filename_pattern, indexed_fields):  
+# Directories already created during this run, so os.makedirs is not called for every file  
+_created_directories = set()  
+CREATED_DIRECTORIES_CACHE_LIMIT = 100000  
+  
+def ensure_directory(directory):  
+    """os.makedirs(directory, exist_ok=True), skipped for directories this process already created."""  
+    if directory in _created_directories:  
+        return  
+    os.makedirs(directory, exist_ok=True)  
+    if len(_created_directories) >= CREATED_DIRECTORIES_CACHE_LIMIT:  
+        _created_directories.clear()  # Keep memory bounded when the pattern creates one folder per record  
+    _created_directories.add(directory)  
+  
+  
+def create_filename(title, file_extension, output_directory, filename_pattern, indexed_fields, make_directories=True):  
     """  
     Creates a sanitized filename, removes double extensions, and returns filename and debug mask.  
       
@@ -98,6 +231,7 @@ def create_filename(title, file_extension, output_directory, filename_pattern, i
         output_directory (str): Directory to save the file.  
         filename_pattern (str): Pattern for filename formatting.  
         indexed_fields (list): List of additional fields to include in filename.  
+        make_directories (bool): Create the file's folder (False for sinks that do not write loose files).  
       
     Returns:  
         tuple: (full_path, full_path_mask) representing the sanitized file path and mask.  
@@ -125,7 +259,8 @@ def create_filename(title, file_extension, output_directory, filename_pattern, i
   
     # Construct the full path and ensure directory exists  
     full_path = os.path.join(output_directory, filename)  
-    os.makedirs(os.path.dirname(full_path), exist_ok=True)  
+    if make_directories:  
+        ensure_directory(os.path.dirname(full_path))  
   
     # Generate the corresponding illegal mask aligned with final path  
     full_path_mask = os.path.join(  
@@ -175,7 +310,98 @@ def extract_fields_from_soql(soql):
     return field_list  
     
   
+class RecordLayout:  
+    """  
+    Precompiled field accessors for one result shape: maps each field path (as given, and lower-cased)  
+    to its position in a CompactRecord, so a lookup is one dict hit instead of a split-and-walk.  
+    """  
+
+    def __init__(self, field_paths):  
+        self.field_paths = list(field_paths)  
+        self.positions = {}  
+        for position, path in enumerate(self.field_paths):  
+            self.positions.setdefault(path, position)  
+            self.positions.setdefault(path.lower(), position)  
+
+    def position(self, field_path):  
+        position = self.positions.get(field_path)  
+        return position if position is not None else self.positions.get(field_path.lower())  
+
+
+class CompactRecord:  
+    """One result row as a tuple of values in RecordLayout order. Behaves like a record dict for .get(field_path)."""  
+    __slots__ = ('layout', 'values')  
+
+    def __init__(self, layout, values):  
+        self.layout = layout  
+        self.values = values  
+
+    def get(self, field_path, default=None):  
+        position = self.layout.position(field_path)  
+        if position is None or self.values[position] is None:  
+            return default  
+        return self.values[position]  
+
+
+class RecordProjection:  
+    """  
+    Compiles the SOQL field list once into accessor tuples and converts each record on arrival into a  
+    CompactRecord holding only what the export reads: the selected fields first (in SOQL order, so  
+    field_values() is a tuple slice), then Id, title/extension, blob URL, size, checksum, modstamp  
+    and any extra paths (e.g. the ID filter field). The raw nested dict can be released right away.  
+    """  
+
+    def __init__(self, field_list, salesforce_object, extra_paths=()):  
+        self.field_list = list(field_list)  
+        self.salesforce_object = salesforce_object  
+        if salesforce_object == 'attachment':  
+            used_paths = ['Id', 'Name', 'ContentType', 'Body']  
+        else:  
+            used_paths = ['Id', 'Title', 'FileExtension'] + VERSION_DATA_FIELD_PATHS  
+        used_paths += SIZE_FIELD_PATHS + CHECKSUM_FIELD_PATHS + MODSTAMP_FIELD_PATHS + list(extra_paths)  
+        # Deduplicated by exact case: REST records are keyed in the API's casing, so a SOQL 'id' reads  
+        # nothing there and Id needs its own accessor (RecordLayout prefers the exact-case match)  
+        selected = set(self.field_list)  
+        paths = list(self.field_list)  
+        for path in used_paths:  
+            if path not in selected:  
+                paths.append(path)  
+                selected.add(path)  
+        self.layout = RecordLayout(paths)  
+        self.field_count = len(self.field_list)  
+        self._accessors = tuple(tuple(path.split('.')) for path in paths)  
+
+    def project(self, record):  
+        """Converts a REST record (nested dicts) into a CompactRecord in this projection's layout."""  
+        values = []  
+        for fields in self._accessors:  
+            value = record  
+            for fld in fields:  
+                value = value.get(fld) if isinstance(value, dict) else None  
+                if value is None:  
+                    break  
+            values.append(value)  
+        return CompactRecord(self.layout, tuple(values))  
+
+    def projector(self, source_layout):  
+        """Returns a function converting a flat value list laid out as source_layout (e.g. a Bulk CSV row) into a CompactRecord."""  
+        positions = tuple(source_layout.position(path) for path in self.layout.field_paths)  
+        layout = self.layout  
+
+        def project_values(values):  
+            return CompactRecord(layout, tuple(None if position is None else values[position] for position in positions))  
+        return project_values  
+
+    def field_values(self, record):  
+        """Values of field_list (SOQL order) for one record."""  
+        if isinstance(record, CompactRecord) and record.layout is self.layout:  
+            return record.values[:self.field_count]  
+        return [get_nested_field(record, path) for path in self.field_list]  
+
+
 def get_nested_field(record, field_path):  
+    if isinstance(record, CompactRecord):  
+        return record.get(field_path)  
     fields = field_path.split('.')  
     value = record  
     for fld in fields:  
@@ -189,276 +415,2876 @@ def get_nested_field(record, field_path):
 
 
   
-def download_file(args):  
-    record, output_directory, sf, results_path, filename_pattern, metadata_field_indexes, total_files, progress_counter, field_list, session, salesforce_object, metadata_dict = args      
-  
-    indexed_fields = [get_nested_field(record, field_list[idx - 1]) or 'Unknown' for idx in range(1, len(field_list) + 1)]  
-    if salesforce_object == 'attachment':  
-        title = get_nested_field(record, 'Name') or 'NoTitle'  
-        content_type = get_nested_field(record, 'ContentType') or 'application/octet-stream'  
-        file_extension = content_type.split('/')[-1]  # minimal way to guess extension from MIME type  
-    else:  
-        title = get_nested_field(record, 'Title') or 'NoTitle'  
-        file_extension = get_nested_field(record, 'FileExtension') or ''   
-  
-    # Create sanitized filename and illegal chars mask  
-    filename, illegal_mask = create_filename(title, file_extension, output_directory, filename_pattern, indexed_fields)  
-  
-    # Prepare metadata row independently of file download success  
-    metadata_row = [get_nested_field(record, field_list[idx - 1]) or '' for idx in metadata_field_indexes]  
-  
-    status = 'Not Attempted'  
-      
-    if salesforce_object == 'attachment':  
-        body_url = record.get('Body')  
-        if not body_url:  
-            status = 'Failed (No Body URL)'  
-        else:  
-            url = f"https://{sf.sf_instance}{body_url}"  
-            try:  
-                response = session.get(url, headers={  
-                    "Authorization": "OAuth " + sf.session_id,  
-                    "Content-Type": "application/octet-stream"  
-                }, timeout=600)  
-      
-                if response.ok:  
-                    os.makedirs(os.path.dirname(filename), exist_ok=True)  
-                    with open(filename, "wb") as file_out:  
-                        file_out.write(response.content)  
-                    status = 'Success'  
+# Upper bounds (seconds) of the per-file download latency histogram  
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, float('inf'))  
+
+
+class ProgressTracker:  
+    """  
+    Thread-safe progress counter and export metrics. The total starts at the query's totalSize and is  
+    reduced as records are filtered out, since the full result set is never materialized up front.  
+    Bytes, per-file latency, retries and HTTP statuses are collected alongside, and the ETA is based on  
+    the remaining BodyLength/ContentSize bytes (falling back to the file count when sizes are unknown).  
+    """  
+    PRINT_INTERVAL = 0.5  # Seconds between progress line refreshes  
+
+    def __init__(self, label=''):  
+        self.label = label  
+        self.total = 0  
+        self.completed = 0  
+        self.started = time.monotonic()  
+        self.seen = 0  # Records handed to the downloader  
+        self.sized = 0  # ... of which had a BodyLength/ContentSize  
+        self.expected_bytes = 0  
+        self.completed_expected_bytes = 0  
+        self.bytes_downloaded = 0  
+        self.outcomes = {}  
+        self.http_statuses = {}  
+        self.retries = {}  
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)  
+        self.latency_sum = 0.0  
+        self.latency_count = 0  
+        self.record_queue = None  
+        self.throttle = None  
+        self._last_print = 0.0  
+
+    def watch(self, record_queue=None, throttle=None):  
+        """Sources of the queue depth, in-flight request and concurrency limit gauges."""  
+        self.record_queue = record_queue  
+        self.throttle = throttle  
+
+    def set_total(self, total):  
+        with status_lock:  
+            self.total = total  
+
+    def discount(self, count=1):  
+        with status_lock:  
+            self.total -= count  
+
+    def add_total(self, count):  
+        """Adds the totalSize of one more query (several run in parallel when the ID list is pushed into SOQL)."""  
+        with status_lock:  
+            self.total += count  
+
+    def add_expected(self, size):  
+        """Registers a record handed to the downloader with its expected size (None when unknown)."""  
+        with status_lock:  
+            self.seen += 1  
+            if size is not None:  
+                self.sized += 1  
+                self.expected_bytes += size  
+
+    def record_response(self, status_code):  
+        with status_lock:  
+            self.http_statuses[status_code] = self.http_statuses.get(status_code, 0) + 1  
+
+    def record_retry(self, kind='download'):  
+        with status_lock:  
+            self.retries[kind] = self.retries.get(kind, 0) + 1  
+
+    def observe_latency(self, seconds):  
+        with status_lock:  
+            self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1  
+            self.latency_sum += seconds  
+            self.latency_count += 1  
+
+    def advance(self, status='Success', bytes_written=0, expected_size=None):  
+        with status_lock:  
+            self.completed += 1  
+            outcome = status.split(' (')[0]  
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1  
+            self.bytes_downloaded += bytes_written  
+            self.completed_expected_bytes += expected_size or 0  
+            now = time.monotonic()  
+            if now - self._last_print < self.PRINT_INTERVAL and self.completed < self.total:  
+                return  
+            self._last_print = now  
+            total = max(self.total, self.completed)  
+            eta = self._eta(now)  
+            eta_text = time.strftime('%H:%M:%S', time.gmtime(eta)) if eta is not None else '--:--:--'  
+            print(f"\r{self.label}Progress: {self.completed}/{total} files completed ({self.completed/total:.1%}), {self.bytes_downloaded / 1048576:.1f} MB, ETA {eta_text}", end='', flush=True)  
+
+    def _remaining_bytes(self):  
+        if not self.sized:  
+            return None  
+        unseen = max(self.total - self.seen, 0)  
+        return max(self.expected_bytes - self.completed_expected_bytes, 0) + unseen * self.expected_bytes / self.sized  
+
+    def _eta(self, now):  
+        """Seconds left at the current rate. Call with status_lock held."""  
+        elapsed = now - self.started  
+        remaining_bytes = self._remaining_bytes()  
+        if remaining_bytes is not None and self.completed_expected_bytes:  
+            return remaining_bytes / (self.completed_expected_bytes / elapsed)  
+        if self.completed:  
+            return max(self.total - self.completed, 0) / (self.completed / elapsed)  
+        return None  
+
+    def snapshot(self):  
+        """Point-in-time copy of every metric, as written to the JSON stats file."""  
+        queue_depth = self.record_queue.qsize() if self.record_queue is not None else 0  
+        limiter = self.throttle.limiter if self.throttle else None  
+        with status_lock:  
+            now = time.monotonic()  
+            elapsed = now - self.started  
+            return {  
+                'timestamp': datetime.now(timezone.utc).isoformat(),  
+                'label': self.label.strip(),  
+                'elapsed_seconds': round(elapsed, 3),  
+                'total_records': self.total,  
+                'completed': self.completed,  
+                'outcomes': dict(self.outcomes),  
+                'bytes_downloaded': self.bytes_downloaded,  
+                'bytes_per_second': round(self.bytes_downloaded / elapsed, 1) if elapsed > 0 else 0,  
+                'remaining_bytes': self._remaining_bytes(),  
+                'eta_seconds': self._eta(now),  
+                'queue_depth': queue_depth,  
+                'in_flight': limiter.in_flight if limiter else 0,  
+                'concurrency_limit': int(limiter.limit) if limiter else None,  
+                'http_statuses': {str(code): count for code, count in self.http_statuses.items()},  
+                'retries': dict(self.retries),  
+                'latency_buckets': {('+Inf' if bound == float('inf') else str(bound)): count for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)},  
+                'latency_sum_seconds': round(self.latency_sum, 6),  
+                'latency_count': self.latency_count,  
+            }  
+
+    def render_prometheus(self):  
+        """The metrics in the Prometheus text exposition format."""  
+        stats = self.snapshot()  
+        lines = []  
+
+        def metric(name, kind, help_text, samples):  
+            lines.append(f"# HELP sf_export_{name} {help_text}")  
+            lines.append(f"# TYPE sf_export_{name} {kind}")  
+            for labels, value in samples:  
+                label_text = ','.join(f'{key}="{label_value}"' for key, label_value in labels.items())  
+                lines.append(f"sf_export_{name}{{{label_text}}} {value}" if label_text else f"sf_export_{name} {value}")  
+
+        metric('records', 'gauge', 'Records the query returned after ID filtering.', [({}, stats['total_records'])])  
+        metric('files_completed_total', 'counter', 'Files finished, by outcome.', [({'outcome': outcome}, count) for outcome, count in stats['outcomes'].items()])  
+        metric('bytes_downloaded_total', 'counter', 'Bytes written to disk.', [({}, stats['bytes_downloaded'])])  
+        metric('remaining_bytes', 'gauge', 'Estimated bytes left to download.', [({}, stats['remaining_bytes'] if stats['remaining_bytes'] is not None else 'NaN')])  
+        metric('eta_seconds', 'gauge', 'Estimated seconds until the export completes.', [({}, stats['eta_seconds'] if stats['eta_seconds'] is not None else 'NaN')])  
+        metric('queue_depth', 'gauge', 'Records fetched by the query and waiting for a download slot.', [({}, stats['queue_depth'])])  
+        metric('requests_in_flight', 'gauge', 'HTTP downloads currently in progress.', [({}, stats['in_flight'])])  
+        if stats['concurrency_limit'] is not None:  
+            metric('concurrency_limit', 'gauge', 'Current adaptive limit on in-flight downloads.', [({}, stats['concurrency_limit'])])  
+        metric('http_responses_total', 'counter', 'Download responses by HTTP status ("error" for connection failures).', [({'code': code}, count) for code, count in stats['http_statuses'].items()])  
+        metric('retries_total', 'counter', 'Retried requests, by kind.', [({'kind': kind}, count) for kind, count in stats['retries'].items()])  
+        cumulative = 0  
+        buckets = []  
+        for bound, count in stats['latency_buckets'].items():  
+            cumulative += count  
+            buckets.append(({'le': bound}, cumulative))  
+        lines.append("# HELP sf_export_file_latency_seconds Time to download one file, including retries.")  
+        lines.append("# TYPE sf_export_file_latency_seconds histogram")  
+        lines.extend(f'sf_export_file_latency_seconds_bucket{{le="{labels["le"]}"}} {value}' for labels, value in buckets)  
+        lines.append(f"sf_export_file_latency_seconds_sum {stats['latency_sum_seconds']}")  
+        lines.append(f"sf_export_file_latency_seconds_count {stats['latency_count']}")  
+        return '\n'.join(lines) + '\n'  
+
+
+class MetricsServer:  
+    """Serves the export metrics at http://host:port/metrics (Prometheus text) and /stats (JSON) from a background thread."""  
+
+    def __init__(self, progress, port, host='127.0.0.1'):  
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):  
+            def do_GET(handler):  
+                if handler.path.split('?')[0] == '/metrics':  
+                    body, content_type = progress.render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'  
+                elif handler.path.split('?')[0] == '/stats':  
+                    body, content_type = json.dumps(progress.snapshot()).encode('utf-8'), 'application/json'  
                 else:  
-                    status = f"Failed (HTTP {response.status_code})"  
-      
-            except requests.exceptions.RequestException as e:  
-                status = f"Failed (Exception: {str(e)})"  
-      
-    else:  # Existing logic unchanged for ContentDocument/ContentVersion  
-        version_data_url = get_nested_field(record, 'LatestPublishedVersion.VersionData') or get_nested_field(record, 'ContentDocument.LatestPublishedVersion.VersionData') or record.get('VersionData')  
-        if not version_data_url:  
-            status = 'Failed (No VersionData URL)'  
-        else:  
-            url = f"https://{sf.sf_instance}{version_data_url}"  
+                    handler.send_error(404)  
+                    return  
+                handler.send_response(200)  
+                handler.send_header('Content-Type', content_type)  
+                handler.send_header('Content-Length', str(len(body)))  
+                handler.end_headers()  
+                handler.wfile.write(body)  
+
+            def log_message(handler, format, *args):  
+                pass  
+
+        self.server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)  
+        self.server.daemon_threads = True  
+        self._thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True)  
+
+    def start(self):  
+        self._thread.start()  
+        host, port = self.server.server_address[:2]  
+        logging.info(f"Serving metrics at http://{host}:{port}/metrics")  
+        return self  
+
+    def stop(self):  
+        self.server.shutdown()  
+        self.server.server_close()  
+
+
+class StatsFileWriter:  
+    """Rewrites a JSON stats file every interval seconds (atomically, via a temporary file) and once more at the end."""  
+
+    def __init__(self, progress, path, interval=10.0):  
+        self.progress = progress  
+        self.path = path  
+        self.interval = interval  
+        self._stopped = threading.Event()  
+        self._thread = threading.Thread(target=self._run, name='StatsFileWriter', daemon=True)  
+
+    def start(self):  
+        self._thread.start()  
+        return self  
+
+    def write(self):  
+        temp_path = self.path + '.tmp'  
+        try:  
+            with open(temp_path, 'w', encoding='utf-8') as f_stats:  
+                json.dump(self.progress.snapshot(), f_stats, indent=2)  
+            os.replace(temp_path, self.path)  
+        except OSError as e:  
+            logging.warning(f"Could not write stats file {self.path}: {e}")  
+
+    def _run(self):  
+        while not self._stopped.wait(self.interval):  
+            self.write()  
+
+    def stop(self):  
+        self._stopped.set()  
+        self._thread.join()  
+        self.write()  
+
+
+class DownloadProfiler:  
+    """  
+    Optional cProfile hooks (--profile). wrap() profiles every call of a worker function in the  
+    thread that runs it; the per-thread profiles are merged into one pstats file by dump().  
+    """  
+
+    def __init__(self):  
+        self._local = threading.local()  
+        self._profiles = []  
+        self._lock = threading.Lock()  
+
+    def _thread_profile(self):  
+        profile = getattr(self._local, 'profile', None)  
+        if profile is None:  
+            profile = self._local.profile = cProfile.Profile()  
+            with self._lock:  
+                self._profiles.append(profile)  
+        return profile  
+
+    def wrap(self, function):  
+        def profiled(*args, **kwargs):  
+            profile = self._thread_profile()  
             try:  
-                response = session.get(url, headers={  
-                    "Authorization": "OAuth " + sf.session_id,  
-                    "Content-Type": "application/octet-stream"  
-                }, timeout=600)  
-      
-                if response.ok:  
-                    os.makedirs(os.path.dirname(filename), exist_ok=True)  
-                    with open(filename, "wb") as file_out:  
-                        file_out.write(response.content)  
-                    status = 'Success'  
-                else:  
-                    status = f"Failed (HTTP {response.status_code})"  
-      
-            except requests.exceptions.RequestException as e:  
-                status = f"Failed (Exception: {str(e)})"  
-  
-    # Correct minimal update to metadata_dict (no CSV write here!)  
-    with csv_writer_lock:  
-        unique_id = record.get('Id')  
-        file_name_only = os.path.basename(filename)  
-        xls_hyperlink = f'=HYPERLINK("{filename}", "{file_name_only}")'  
-        metadata_dict[unique_id][-4:] = [filename, xls_hyperlink, status, illegal_mask]  
-  
-    # Thread-safe update of progress  
-    with status_lock:  
-        progress_counter[0] += 1  
-        completed = progress_counter[0]  
-        print(f"\rProgress: {completed}/{total_files} files completed ({completed/total_files:.1%})", end='', flush=True)  
+                profile.enable()  
+            except ValueError:  # Another profiler is already active in this interpreter  
+                return function(*args, **kwargs)  
+            try:  
+                return function(*args, **kwargs)  
+            finally:  
+                profile.disable()  
+        return profiled  
 
+    def dump(self, path):  
+        with self._lock:  
+            profiles = list(self._profiles)  
+        if not profiles:  
+            logging.warning("Nothing was profiled.")  
+            return  
+        stats = pstats.Stats(profiles[0])  
+        for profile in profiles[1:]:  
+            stats.add(profile)  
+        stats.dump_stats(path)  
+        logging.info(f"Profile written to {path} (inspect with: python -m pstats {path})")  
 
-  
-def fetch_files(sf, results, output_directory, filename_pattern, results_path, metadata_field_indexes, batch_size, thread_count, field_list, salesforce_object, metadata_dict, metadata_header):    
-    total_files = len(results)  
-    progress_counter = [0]  
-  
-    # Robust slicing logic to ensure no records are skipped  
-    total_files = len(results)  
-    progress_counter = [0]  
-      
-    with requests.Session() as session:  # HTTP session reuse implemented here  
-        session.headers.update({"Authorization": "OAuth " + sf.session_id})  
-      
-        # Explicitly slice records into batches using Python list comprehension  
-        batches = [results[i:i + batch_size] for i in range(0, len(results), batch_size)]  
-        total_batches = len(batches)  
-        logging.info(f"Total batches to process: {total_batches}")  
-      
-        for idx, batch in enumerate(batches, 1):  
-            logging.info(f"Processing batch {idx}/{total_batches}...")  
-            args_list = [  
-                (  
-                    record, output_directory, sf, results_path, filename_pattern,  
-                    metadata_field_indexes, total_files, progress_counter, field_list,  
-                    session, salesforce_object, metadata_dict  
-                ) for record in batch  
-            ]       
-      
-            with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:  
-                executor.map(download_file, args_list)   
-      
-        print("\nDownload process completed successfully.")  
-        
-    # Write fully updated metadata back to CSV after all downloads  
-    with csv_writer_lock:  
-        with open(results_path, 'w', encoding='utf-8', newline='') as f_csv:  
-            writer = csv.writer(f_csv)  
-            writer.writerow(metadata_header)  
-            for row in metadata_dict.values():  
-                writer.writerow(row)  
-  
+
+def _mask_nested_soql(soql):  
+    """Blanks out quoted literals and parenthesised sub-expressions so clause keywords can be located at the top level."""  
+    masked = []  
+    depth = 0  
+    in_quote = escaped = False  
+    for c in soql:  
+        if in_quote:  
+            masked.append(' ')  
+            if escaped:  
+                escaped = False  
+            elif c == '\\':  
+                escaped = True  
+            elif c == "'":  
+                in_quote = False  
+        elif c == "'":  
+            in_quote = True  
+            masked.append(' ')  
+        elif c in '()':  
+            depth += 1 if c == '(' else -1  
+            masked.append(' ')  
+        else:  
+            masked.append(c if depth == 0 else ' ')  
+    return ''.join(masked)  
 
 
-def main():  
-    parser = argparse.ArgumentParser(description='Export Salesforce ContentVersion Files')  
-    
-                        
-    parser.add_argument('-q', '--query', required=True, help='SOQL query to select files.  You can query from ContentDocument, ContentDocumentLink, ContentVersion or Attachment object.  All selected fields included in SOQL can be ported to -f and/or -m arguments for flexibility.  Manditory Include ContentVersion.VersionData or Attachment.Body for File Creation.')  
-    parser.add_argument('-f', '--filenamepattern', default='{1}\{2}.{3}',  
-                        help='Filename pattern using indexed SOQL fields, default: {1}\{2}.{3}  Be Aware that if you dont specify the ID Column in this pattern, you may end up having duplicate filenames overwrite each other which will make it seem that not all files are extracted.')  
-    parser.add_argument('-m', '--metadata', default='1,2,3' , required=True,
-                        help='Comma-separated indexed fields for metadata CSV output, e.g. "1,2,3"')  
-    parser.add_argument('-t', '--threadcount', type=int, default=10,  
-                        help='Number of concurrent threads (default: 10)')  
-    args = parser.parse_args()  
-  
-    config = configparser.ConfigParser()  
-    config.read('download.ini')  
-  
-    # Salesforce credentials setup  
-    username = config.get('salesforce', 'username', fallback=None)  
-    if not username:  
-        username = input("Please enter Salesforce username: ")  
-    password = config.get('salesforce', 'password', fallback=None)  
-    if not password:  
-        password = getpass.getpass("Please enter Salesforce password: ")  
-    token = config.get('salesforce', 'security_token', fallback=None)  
-    if not token:  
-        token = getpass.getpass("Please enter Salesforce security token: ")  
-  
-    is_sandbox = config['salesforce'].getboolean('connect_to_sandbox', False)  
-    domain = config['salesforce'].get('domain', '')  
-    domain = f"{domain}.my" if domain else ('test' if is_sandbox else 'login')  
-  
-    output_directory = config['salesforce']['output_dir']  
-    batch_size = int(config['salesforce']['batch_size'])  
-    loglevel = logging.getLevelName(config['salesforce']['loglevel'])  
-    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=loglevel)  
-  
-    logging.info('Connecting to Salesforce...')  
-    sf = Salesforce(username=username, password=password, security_token=token, domain=domain)  
-    logging.info('Connected successfully.')  
-  
-    os.makedirs(output_directory, exist_ok=True)  
-    results_path = os.path.join(output_directory, 'files_metadata.csv')  
-  
-    field_list = extract_fields_from_soql(args.query)  
-    metadata_field_indexes = [int(i.strip()) for i in args.metadata.split(',')]  
-  
-    metadata_header = [field_list[idx - 1] for idx in metadata_field_indexes] + ['FilePath', 'XLS_Link_FilePath', 'Status', 'Illegal_Chars_Stripped']  
-  
-    # Execute SOQL query  
-    logging.info('Executing SOQL query to retrieve files...')  
-    query_result = sf.query_all(args.query)  
-    records = query_result.get('records', [])  
-    total_records = len(records)  
-    logging.info(f"Retrieved {total_records} records.")  
-  
-    # Identify Salesforce object from SOQL query (must happen here before filtering)  
-    soql_object_match = re.search(r'FROM\s+(\w+)', args.query, re.IGNORECASE)  
-    if not soql_object_match:  
-        logging.error("Unable to parse Salesforce object from SOQL query.")  
-        exit(1)  
-  
-    salesforce_object = soql_object_match.group(1).lower()  
-  
-    # ---- START OF ROBUST ID FILTERING LOGIC ----  
-    csv_id_filepath = config.get('RecordFiltering', 'Attachments_list_CSV_filepath', fallback=None)  
-    include_or_exclude = config.get('RecordFiltering', 'AttachID_list_Incl_or_Excl', fallback='Include').strip().lower()  
-  
-    if csv_id_filepath:  
-        id_list_from_csv = load_id_list_from_csv(csv_id_filepath)  
-        original_record_count = len(records)  
-  
-        # Explicitly determine the correct ID field based on Salesforce object  
-        if salesforce_object == 'attachment':  
-            sf_id_field = 'Id'  
-        elif salesforce_object == 'contentdocument':  
-            sf_id_field = 'LatestPublishedVersion.Id'  or 'LatestPublishedVersionId' 
-        elif salesforce_object == 'contentversion':  
-            sf_id_field = 'Id'  
-        elif salesforce_object == 'contentdocumentlink':  
-            sf_id_field = 'ContentDocument.LatestPublishedVersionId' or  'ContentDocument.LatestPublishedVersion.Id'  
+def split_soql(soql):  
+    """  
+    Splits a SOQL statement into its top-level parts, ignoring sub-queries and string literals.  
+
+    Returns:  
+        tuple: (select_and_from, where_expression, tail) where where_expression is '' when the query  
+        has no WHERE clause and tail holds everything from WITH/GROUP BY/ORDER BY/LIMIT/OFFSET on.  
+    """  
+    masked = _mask_nested_soql(soql)  
+    from_match = re.search(r'\bFROM\s+\w+', masked, re.IGNORECASE)  
+    if not from_match:  
+        raise ValueError("Invalid SOQL Query. Could not find the FROM clause.")  
+    tail_match = re.compile(r'\b(WITH|GROUP\s+BY|ORDER\s+BY|LIMIT|OFFSET|FOR\s+(VIEW|REFERENCE|UPDATE))\b', re.IGNORECASE).search(masked, from_match.end())  
+    tail_start = tail_match.start() if tail_match else len(soql)  
+    where_match = re.compile(r'\bWHERE\b', re.IGNORECASE).search(masked, from_match.end(), tail_start)  
+    if where_match:  
+        return soql[:where_match.start()].strip(), soql[where_match.end():tail_start].strip(), soql[tail_start:].strip()  
+    return soql[:tail_start].strip(), '', soql[tail_start:].strip()  
+
+
+def add_soql_condition(soql, condition):  
+    """Returns soql with condition ANDed into its top-level WHERE clause (or a new WHERE clause)."""  
+    head, where, tail = split_soql(soql)  
+    where = f"({where}) AND ({condition})" if where else condition  
+    return f"{head} WHERE {where} {tail}".strip()  
+
+
+def has_row_limit(soql):  
+    """True if the query has a top-level LIMIT or OFFSET, which a split query would apply once per part."""  
+    _, _, tail = split_soql(soql)  
+    return bool(re.search(r'\b(LIMIT|OFFSET)\b', _mask_nested_soql(tail), re.IGNORECASE))  
+
+
+# Base64 fields cannot be queried through Bulk API 2.0; their REST URL is rebuilt from the record Id instead  
+BULK_BLOB_FIELDS = {'versiondata': ('ContentVersion', 'VersionData'), 'body': ('Attachment', 'Body')}  
+
+
+def build_bulk_query(soql):  
+    """  
+    Rewrites a SOQL query for Bulk API 2.0, which returns neither base64 fields (VersionData, Body)  
+    nor TYPEOF fields. Each blob field is dropped from the SELECT list and the Id on the same  
+    relationship path is selected instead (if it is not already), so its URL can be rebuilt per row.  
+
+    Returns:  
+        tuple: (bulk_soql, blob_fields) where blob_fields lists (blob_field_path, id_field_path, sobject_name, blob_field_name).  
+    """  
+    if re.search(r'\bTYPEOF\b', _mask_nested_soql(soql), re.IGNORECASE):  
+        raise ValueError("Bulk API 2.0 does not support TYPEOF; use --queryapi rest for this query.")  
+    select_fields = []  
+    blob_fields = []  
+    for field in extract_fields_from_soql(soql):  
+        prefix, _, name = field.rpartition('.')  
+        if name.lower() in BULK_BLOB_FIELDS:  
+            sobject_name, blob_field_name = BULK_BLOB_FIELDS[name.lower()]  
+            blob_fields.append((field, f"{prefix}.Id" if prefix else 'Id', sobject_name, blob_field_name))  
         else:  
-            logging.error(f"Unsupported Salesforce object for ID filtering: {salesforce_object}.")  
-            exit(1)  
-  
-        # Use get_nested_field to handle nested fields correctly  
-        if include_or_exclude == 'exclude':  
-            records = [rec for rec in records if get_nested_field(rec, sf_id_field) not in id_list_from_csv]  
-            logging.info(f"Excluding IDs from CSV: {original_record_count - len(records)} records removed.")  
-        else:  # default to include  
-            records = [rec for rec in records if get_nested_field(rec, sf_id_field) in id_list_from_csv]  
-            logging.info(f"Including only IDs from CSV: {original_record_count - len(records)} records removed.")  
-  
-        total_records = len(records)  
-        logging.info(f"Total records after filtering: {total_records}")  
-    # ---- END OF ROBUST ID FILTERING LOGIC ----  
-  
-    # Create metadata dictionary indexed by unique record ID  
-    metadata_dict = {}  
-    for record in records:  
-        unique_id = record.get('Id')  
-        metadata_row = [get_nested_field(record, field_list[idx - 1]) or '' for idx in metadata_field_indexes]  
-        metadata_dict[unique_id] = metadata_row + ['Not Created', 'N/a', 'Failed', 'N/a']  
-  
-    # Write initial metadata file with default failed status  
-    with open(results_path, 'w', encoding='utf-8', newline='') as f_csv:  
-        writer = csv.writer(f_csv)  
-        writer.writerow(metadata_header)  
-        for row in metadata_dict.values():  
-            writer.writerow(row)  
-  
-    # Required fields validation  
-    required_fields = []  
-    if salesforce_object == 'attachment':  
-        required_fields = ['Body', 'BodyLength', 'ContentType']  
-    elif salesforce_object in ['contentdocument', 'contentversion', 'contentdocumentlink']:  
-        required_fields = ['VersionData']  
-    else:  
-        logging.error(f"Unsupported Salesforce object: {salesforce_object}.")  
-        exit(1)  
-  
-    missing_fields = []  
-    for req_field in required_fields:  
-        if not any(f.split('.')[-1] == req_field for f in field_list):  
-            missing_fields.append(req_field)  
-  
-    if missing_fields:  
-        logging.error(f"SOQL query missing required fields for {salesforce_object}: {missing_fields}")  
-        exit(1)  
-  
-    if total_records == 0:  
-        logging.info("No records found. Exiting.")  
-        return  
-  
-    # Fetch and download files concurrently  
-    fetch_files(  
-        sf=sf,  
-        results=records,  
-        output_directory=output_directory,  
-        filename_pattern=args.filenamepattern,  
-        results_path=results_path,  
-        metadata_field_indexes=metadata_field_indexes,  
-        batch_size=batch_size,  
-        thread_count=args.threadcount,  
-        field_list=field_list,  
-        salesforce_object=salesforce_object,  
-        metadata_dict=metadata_dict,  
-        metadata_header=metadata_header  
-    )  
+            select_fields.append(field)  
+    selected = {field.lower() for field in select_fields}  
+    for _, id_field, _, _ in blob_fields:  
+        if id_field.lower() not in selected:  
+            select_fields.append(id_field)  
+            selected.add(id_field.lower())  
+    fields_section = re.search(r'\s*SELECT\s+(.*?)\s+FROM\s+', soql, re.IGNORECASE | re.DOTALL)  
+    return soql[:fields_section.start(1)] + ', '.join(select_fields) + soql[fields_section.end(1):], blob_fields  
+
+
+def classify_http_failure(status_code, body=''):  
+    """  
+    Classifies a failed blob response.  
+
+    Returns:  
+        tuple: (retryable, throttled). throttled means the org is pushing back (429/503 or  
+        REQUEST_LIMIT_EXCEEDED) and the adaptive limiter should lower concurrency.  
+    """  
+    throttled = status_code in (429, 503) or (status_code == 403 and 'REQUEST_LIMIT_EXCEEDED' in (body or ''))  
+    return throttled or status_code in RETRYABLE_STATUS_CODES, throttled  
+
+
+def parse_retry_after(value):  
+    """Returns the Retry-After header as seconds, or None if absent or not a plain number."""  
+    try:  
+        return max(float(value), 0.0) if value is not None else None  
+    except ValueError:  
+        return None  
+
+
+class CircuitBreaker:  
+    """  
+    Stops all workers from hammering the org once failures pile up. After failure_threshold  
+    consecutive retryable failures the breaker opens for a cool-down period, during which  
+    wait_time() tells callers how long to hold off. The next failure after a cool-down reopens  
+    it with a doubled period (up to max_cooldown); any success closes it again.  
+    """  
+
+    def __init__(self, failure_threshold=10, cooldown=30.0, max_cooldown=600.0):  
+        self.failure_threshold = failure_threshold  
+        self.cooldown = cooldown  
+        self.max_cooldown = max_cooldown  
+        self.consecutive_failures = 0  
+        self.open_until = 0.0  
+        self._current_cooldown = cooldown  
+        self._lock = threading.Lock()  
+
+    def wait_time(self):  
+        return max(0.0, self.open_until - time.monotonic())  
+
+    def record_success(self):  
+        with self._lock:  
+            self.consecutive_failures = 0  
+            self._current_cooldown = self.cooldown  
+
+    def record_failure(self):  
+        with self._lock:  
+            self.consecutive_failures += 1  
+            now = time.monotonic()  
+            if self.consecutive_failures >= self.failure_threshold and now >= self.open_until:  
+                self.open_until = now + self._current_cooldown  
+                logging.warning(f"Circuit breaker open: {self.consecutive_failures} consecutive failures, pausing requests for {self._current_cooldown:.1f}s")  
+                self._current_cooldown = min(self._current_cooldown * 2, self.max_cooldown)  
+                self.consecutive_failures = self.failure_threshold - 1  # One more failure after the pause reopens it  
+
+
+class AdaptiveConcurrencyLimiter:  
+    """  
+    AIMD limit on in-flight requests: halves the limit when the org throttles us and raises it by  
+    one after a full window of successes, between min_limit and max_limit. Threads block in  
+    acquire(); async tasks await acquire_async(), which queues them first come, first served and  
+    hands each one a slot from release().  
+    """  
+
+    def __init__(self, max_limit, min_limit=1, adaptive=True, decrease_interval=1.0):  
+        self.max_limit = max(max_limit, 1)  
+        self.min_limit = max(min(min_limit, self.max_limit), 1)  
+        self.adaptive = adaptive  
+        self.decrease_interval = decrease_interval  
+        self.limit = float(self.max_limit)  
+        self.in_flight = 0  
+        self._successes = 0  
+        self._last_decrease = 0.0  
+        self._condition = threading.Condition()  
+        self._async_waiters = collections.deque()  # (loop, future) of tasks waiting in acquire_async  
+
+    async def acquire_async(self):  
+        loop = asyncio.get_running_loop()  
+        with self._condition:  
+            if not self._async_waiters and self.in_flight < int(self.limit):  
+                self.in_flight += 1  
+                return  
+            future = loop.create_future()  
+            self._async_waiters.append((loop, future))  
+        try:  
+            await future  
+        except asyncio.CancelledError:  
+            with self._condition:  
+                try:  
+                    self._async_waiters.remove((loop, future))  
+                except ValueError:  
+                    # release() already handed this task a slot; pass it on  
+                    self.in_flight -= 1  
+                    self._wake_async_waiters()  
+            raise  
+
+    def _wake_async_waiters(self):  
+        """Hands free slots to the oldest waiting tasks (called with the condition held)."""  
+        while self._async_waiters and self.in_flight < int(self.limit):  
+            loop, future = self._async_waiters.popleft()  
+            self.in_flight += 1  
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))  
+
+    def acquire(self):  
+        with self._condition:  
+            while self.in_flight >= int(self.limit):  
+                self._condition.wait()  
+            self.in_flight += 1  
+
+    def release(self, throttled=False):  
+        with self._condition:  
+            self.in_flight -= 1  
+            if self.adaptive:  
+                now = time.monotonic()  
+                if throttled:  
+                    self._successes = 0  
+                    # Many in-flight requests see the same throttling burst; only back off once per interval  
+                    if now - self._last_decrease >= self.decrease_interval and self.limit > self.min_limit:  
+                        self.limit = max(self.min_limit, self.limit / 2)  
+                        self._last_decrease = now  
+                        logging.info(f"Throttling detected, lowering concurrency to {int(self.limit)}")  
+                else:  
+                    self._successes += 1  
+                    if self._successes >= int(self.limit) and self.limit < self.max_limit:  
+                        self.limit = min(self.max_limit, self.limit + 1)  
+                        self._successes = 0  
+                        logging.debug(f"Org healthy, raising concurrency to {int(self.limit)}")  
+            self._wake_async_waiters()  
+            self._condition.notify_all()  
+
+
+class RequestThrottle:  
+    """  
+    Retry policy (jittered exponential backoff), circuit breaker and adaptive concurrency limiter  
+    shared by every download worker, so the whole export backs off together when the org pushes back.  
+    """  
+
+    def __init__(self, max_concurrency, max_attempts=5, base_delay=1.0, max_delay=60.0, breaker_threshold=10, breaker_cooldown=30.0, adaptive=True, min_concurrency=1):  
+        self.max_attempts = max(max_attempts, 1)  
+        self.base_delay = base_delay  
+        self.max_delay = max_delay  
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)  
+        self.limiter = AdaptiveConcurrencyLimiter(max_concurrency, min_concurrency, adaptive)  
+
+    def backoff_delay(self, attempt, retry_after=None):  
+        """Full-jitter exponential backoff, never shorter than a server-provided Retry-After."""  
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))  
+        if retry_after is not None:  
+            delay = max(delay, min(retry_after, self.max_delay))  
+        return delay  
+
+
+class SessionManager:  
+    """  
+    The Salesforce session shared by every download worker, query stream and engine of a run,  
+    renewed by logging in again with the [salesforce] login settings. Sessions registered with  
+    attach() carry the Authorization header, which refresh() rewrites in place, so requests never  
+    build their own. A worker that gets a 401 calls refresh() with the token it sent: the first  
+    one logs in while the others wait on the lock, then every one of them retries with the new  
+    token. Tokens older than max_age seconds are renewed before use. With cache_path, the token  
+    is shared through that file (under a lock file) so shard processes renew it once between them  
+    instead of once each. Without login settings (e.g. a session handed in by the caller), the  
+    token is used as-is and a 401 fails as before.  
+    """  
+
+    def __init__(self, sf=None, login=None, cache_path=None, max_age=0):  
+        self.sf = sf  
+        self.login = login  
+        self.cache_path = cache_path  
+        self.max_age = max_age  
+        self.issued_at = time.time()  
+        self.refreshes = 0  
+        self._sessions = []  
+        self._lock = threading.Lock()  
+
+    def connect(self):  
+        """Logs in and returns the Salesforce client bound to the managed session."""  
+        session_id, instance = self._login()  
+        self.sf = Salesforce(session_id=session_id, instance=instance)  
+        self.issued_at = time.time()  
+        with self._cache_lock():  
+            self._write_cache()  
+        return self.sf  
+
+    def __getstate__(self):  
+        """Shard processes get the login settings and current token; sessions and locks stay behind."""  
+        return {'login': self.login, 'cache_path': self.cache_path, 'max_age': self.max_age,  
+                'session': (self.token, self.sf.sf_instance, self.issued_at)}  
+
+    def __setstate__(self, state):  
+        session_id, instance, issued_at = state.pop('session')  
+        self.__init__(Salesforce(session_id=session_id, instance=instance), **state)  
+        self.issued_at = issued_at  
+
+    @property  
+    def token(self):  
+        return self.sf.session_id  
+
+    @property  
+    def can_refresh(self):  
+        return self.login is not None  
+
+    def attach(self, session, scheme='OAuth'):  
+        """Sets the Authorization header of a requests.Session or aiohttp.ClientSession and keeps it current."""  
+        with self._lock:  
+            session.headers['Authorization'] = f"{scheme} {self.token}"  
+            self._sessions.append((session, scheme))  
+        return session  
+
+    def due(self):  
+        """True when the token is older than max_age and should be renewed before the next request."""  
+        return bool(self.max_age and self.can_refresh and time.time() - self.issued_at >= self.max_age)  
+
+    def ensure_fresh(self):  
+        """Renews the token ahead of expiry once it is max_age seconds old."""  
+        if self.due():  
+            self.refresh(self.token)  
+
+    def refresh(self, stale_token):  
+        """  
+        Replaces stale_token (the token a failed request was sent with) by a new one, unless another  
+        worker or shard process already did. Returns the current token, or None if the session  
+        cannot be renewed, in which case the caller fails as it would have without a manager.  
+        """  
+        if not self.can_refresh:  
+            return None  
+        with self._lock:  
+            if self.token != stale_token:  
+                return self.token  # Renewed by another worker while this one waited  
+            try:  
+                with self._cache_lock():  
+                    cached = self._read_cache()  
+                    if cached and cached['session_id'] != stale_token and cached['issued_at'] > self.issued_at:  
+                        session_id, issued_at = cached['session_id'], cached['issued_at']  
+                        logging.info("Using the Salesforce session renewed by another shard.")  
+                    else:  
+                        session_id, _ = self._login()  
+                        issued_at = time.time()  
+                        logging.info("Salesforce session renewed.")  
+                    self._apply(session_id, issued_at)  
+                    self._write_cache()  
+            except Exception as e:  
+                logging.error(f"Failed to renew the Salesforce session: {e}")  
+                return None  
+            self.refreshes += 1  
+            return self.token  
+
+    def _login(self):  
+        """Logs in with the username/password/security token or OAuth JWT bearer settings. Returns (session_id, instance)."""  
+        return SalesforceLogin(**self.login)  
+
+    def _apply(self, session_id, issued_at):  
+        self.sf.session_id = session_id  
+        self.sf.headers['Authorization'] = 'Bearer ' + session_id  
+        self.issued_at = issued_at  
+        for session, scheme in self._sessions:  
+            session.headers['Authorization'] = f"{scheme} {session_id}"  
+
+    def _cache_lock(self):  
+        return FileLock(self.cache_path + '.lock') if self.cache_path else FileLock(None)  
+
+    def _read_cache(self):  
+        if not self.cache_path:  
+            return None  
+        try:  
+            with open(self.cache_path, 'r', encoding='utf-8') as f:  
+                cached = json.load(f)  
+        except (OSError, ValueError):  
+            return None  
+        return cached if cached.get('username') == self.login.get('username') else None  
+
+    def _write_cache(self):  
+        if not self.cache_path:  
+            return  
+        temp_path = self.cache_path + '.tmp'  
+        # The token is a credential: readable by the owner only  
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:  
+            json.dump({'username': self.login.get('username'), 'session_id': self.token, 'issued_at': self.issued_at}, f)  
+        os.replace(temp_path, self.cache_path)  
+
+    def close(self):  
+        """Removes the shared token cache, so the token does not outlive the run on disk."""  
+        if self.cache_path and os.path.exists(self.cache_path):  
+            os.remove(self.cache_path)  
+
+
+class FileLock:  
+    """Cross-process lock held while the lock file exists (O_EXCL create, which also works on Windows). path None is a no-op."""  
+
+    def __init__(self, path, stale_after=120.0):  
+        self.path = path  
+        self.stale_after = stale_after  
+
+    def __enter__(self):  
+        while self.path:  
+            try:  
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))  
+                return self  
+            except FileExistsError:  
+                try:  
+                    if time.time() - os.path.getmtime(self.path) > self.stale_after:  
+                        os.remove(self.path)  # Left behind by a process that died holding it  
+                        continue  
+                except OSError:  
+                    continue  
+                time.sleep(0.1)  
+        return self  
+
+    def __exit__(self, *exc):  
+        if self.path:  
+            try:  
+                os.remove(self.path)  
+            except FileNotFoundError:  
+                pass  
+
+
+class RecordStream:  
+    """  
+    Runs the SOQL query on a background thread and hands records to the downloader through a  
+    bounded queue, page by page (query/query_more via nextRecordsUrl), so downloads start as soon  
+    as the first page arrives and the full result set is never held in memory.  
+
+    query may also be a list of queries (e.g. one per chunk of a pushed-down ID list); they run up  
+    to parallel_queries at a time and their records are merged into the same queue.  
+
+    Note: Salesforce expires an idle query cursor after ~15 minutes, so max_queued should be large  
+    enough that the producer does not sit blocked on a full queue for that long.  
+    """  
+    _DONE = object()  
+
+    def __init__(self, sf, query, progress, record_filter=None, max_queued=10000, throttle=None, projection=None, parallel_queries=4, auth=None):  
+        self.sf = sf  
+        self.auth = auth  
+        self.projection = projection  
+        self.throttle = throttle  
+        self.query = query  
+        self.queries = [query] if isinstance(query, str) else list(query)  
+        self.parallel_queries = max(parallel_queries, 1)  
+        self.progress = progress  
+        self.record_filter = record_filter  
+        self.queue = queue.Queue(maxsize=max_queued)  
+        self.total_size = None  
+        self.filtered_out = 0  
+        self.error = None  
+        self.ready = threading.Event()  # Set once totalSize is known (or the query failed)  
+        self._pending_totals = len(self.queries)  
+        self._lock = threading.Lock()  
+        self._thread = threading.Thread(target=self._produce, name='RecordStream', daemon=True)  
+
+    def start(self):  
+        self._thread.start()  
+        return self  
+
+    def _call_with_retry(self, method, *args, **kwargs):  
+        """Calls a query method, retrying transient API errors with the shared backoff policy and renewing an expired session."""  
+        attempt = 0  
+        while True:  
+            attempt += 1  
+            if self.auth:  
+                self.auth.ensure_fresh()  
+            token = self.auth.token if self.auth else None  
+            try:  
+                return method(*args, **kwargs)  
+            except SalesforceExpiredSession:  
+                if not self.auth or attempt >= (self.throttle.max_attempts if self.throttle else 1) or not self.auth.refresh(token):  
+                    raise  
+            except (SalesforceGeneralError, SalesforceRefusedRequest, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:  
+                # A 403 is retried when the org is throttling us (REQUEST_LIMIT_EXCEEDED), not for missing permissions  
+                refused = isinstance(e, SalesforceRefusedRequest) and not classify_http_failure(e.status, str(e.content))[1]  
+                if refused or not self.throttle or attempt >= self.throttle.max_attempts:  
+                    raise  
+                delay = self.throttle.backoff_delay(attempt)  
+                self.progress.record_retry('query')  
+                logging.warning(f"Query page failed ({e}); retrying in {delay:.1f}s")  
+                time.sleep(delay)  
+
+    def _offer(self, record):  
+        """Projects the record to a compact row, applies the record filter and queues it for download."""  
+        if self.projection and not isinstance(record, CompactRecord):  
+            record = self.projection.project(record)  
+        if self.record_filter and not self.record_filter(record):  
+            with self._lock:  
+                self.filtered_out += 1  
+            self.progress.discount()  
+            return  
+        self.progress.add_expected(get_expected_size(record))  
+        self.queue.put(record)  
+
+    def _add_total(self, size):  
+        """Counts one query's totalSize; ready is set at the first records, or once every query reported none."""  
+        with self._lock:  
+            self.total_size = (self.total_size or 0) + size  
+            self._pending_totals -= 1  
+            self.progress.add_total(size)  
+            if self.total_size or not self._pending_totals:  
+                self.ready.set()  
+
+    def _run_query(self, query):  
+        result = self._call_with_retry(self.sf.query, query)  
+        self._add_total(result.get('totalSize', 0))  
+        while True:  
+            for record in result.get('records', []):  
+                self._offer(record)  
+            if result.get('done', True):  
+                break  
+            result = self._call_with_retry(self.sf.query_more, result['nextRecordsUrl'], identifier_is_url=True)  
+
+    def _produce(self):  
+        try:  
+            if len(self.queries) == 1:  
+                self._run_query(self.queries[0])  
+            else:  
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel_queries, thread_name_prefix='RecordStream') as executor:  
+                    for future in [executor.submit(self._run_query, query) for query in self.queries]:  
+                        future.result()  
+        except Exception as e:  
+            self.error = e  
+        finally:  
+            self.ready.set()  
+            self.queue.put(self._DONE)  
+
+    def __iter__(self):  
+        while True:  
+            record = self.queue.get()  
+            if record is self._DONE:  
+                if self.error:  
+                    raise self.error  
+                return  
+            yield record  
+
+
+class BulkRecordStream(RecordStream):  
+    """  
+    RecordStream fed by a Bulk API 2.0 query job instead of REST query/queryMore (--queryapi bulk).  
+    Result pages of up to page_size rows are streamed as CSV straight from the socket into  
+    CompactRecords (one tuple per row, field accessors compiled once from the CSV header), with  
+    the VersionData/Body URLs rebuilt from the selected Ids. A page whose connection drops mid-read  
+    is fetched again by its locator, skipping the rows already queued.  
+    """  
+
+    def __init__(self, sf, query, progress, record_filter=None, max_queued=10000, throttle=None, projection=None, parallel_queries=4, auth=None, page_size=50000, poll_interval=2.0):  
+        auth = auth or SessionManager(sf)  
+        super().__init__(sf, query, progress, record_filter=record_filter, max_queued=max_queued, throttle=throttle, projection=projection, parallel_queries=parallel_queries, auth=auth)  
+        self.page_size = page_size  
+        self.poll_interval = poll_interval  
+        self.jobs_url = f"{instance_url(sf)}/services/data/v{sf.sf_version}/jobs/query"  
+        self.session = auth.attach(requests.Session(), 'Bearer')  
+
+    def _bulk_request(self, method, url, **kwargs):  
+        response = self.session.request(method, url, timeout=600, **kwargs)  
+        if response.status_code >= 300:  
+            content = response.content  
+            response.close()  
+            if response.status_code == 401:  
+                raise SalesforceExpiredSession(url, response.status_code, 'jobs/query', content)  
+            retryable, _ = classify_http_failure(response.status_code, content.decode('utf-8', 'replace'))  
+            raise (SalesforceGeneralError if retryable else SalesforceError)(url, response.status_code, 'jobs/query', content)  
+        return response  
+
+    def _wait_for_job(self, job_id):  
+        poll_interval = self.poll_interval  
+        while True:  
+            job = self._call_with_retry(self._bulk_request, 'GET', f"{self.jobs_url}/{job_id}").json()  
+            if job['state'] == 'JobComplete':  
+                return job  
+            if job['state'] in ('Failed', 'Aborted'):  
+                raise SalesforceError(f"{self.jobs_url}/{job_id}", 400, 'jobs/query', (job.get('errorMessage') or job['state']).encode('utf-8'))  
+            time.sleep(poll_interval)  
+            poll_interval = min(poll_interval * 1.5, 30.0)  
+
+    def _compile_row_builder(self, header, blob_fields):  
+        """Returns build(row), turning one CSV row into a CompactRecord (in the projection's layout when given)."""  
+        layout = RecordLayout(header + [blob_field for blob_field, _, _, _ in blob_fields])  
+        api_path = f"/services/data/v{self.sf.sf_version}/sobjects"  
+        url_sources = [(layout.position(id_field), f"{api_path}/{sobject_name}/", f"/{blob_field_name}") for _, id_field, sobject_name, blob_field_name in blob_fields]  
+        project_values = self.projection.projector(layout) if self.projection else (lambda values: CompactRecord(layout, tuple(values)))  
+
+        def build(row):  
+            values = [value if value != '' else None for value in row]  
+            values.extend(f"{prefix}{values[position]}{suffix}" if values[position] else None for position, prefix, suffix in url_sources)  
+            return project_values(values)  
+        return build  
+
+    def _run_query(self, query):  
+        bulk_query, blob_fields = build_bulk_query(query)  
+        job = self._call_with_retry(self._bulk_request, 'POST', self.jobs_url, json={'operation': 'query', 'query': bulk_query}).json()  
+        logging.info(f"Bulk API 2.0 query job {job['id']} created; waiting for it to complete...")  
+        job = self._wait_for_job(job['id'])  
+        self._add_total(job.get('numberRecordsProcessed', 0))  
+
+        build = None  
+        locator = None  
+        while True:  
+            params = {'maxRecords': self.page_size}  
+            if locator:  
+                params['locator'] = locator  
+            offered = 0  
+            attempt = 0  
+            while True:  
+                attempt += 1  
+                response = self._call_with_retry(self._bulk_request, 'GET', f"{self.jobs_url}/{job['id']}/results", params=params, stream=True)  
+                try:  
+                    with response:  
+                        response.raw.decode_content = True  
+                        response.raw.auto_close = False  # Let TextIOWrapper see EOF instead of a closed stream  
+                        reader = csv.reader(io.TextIOWrapper(response.raw, encoding='utf-8', newline=''))  
+                        header = next(reader, None)  
+                        if header and build is None:  
+                            build = self._compile_row_builder(header, blob_fields)  
+                        # A page fetched again by the same locator returns the same rows; skip those already queued  
+                        for row in itertools.islice(reader, offered, None):  
+                            self._offer(build(row))  
+                            offered += 1  
+                    break  
+                except (urllib3.exceptions.HTTPError, OSError) as e:  
+                    # The connection dropped while reading the page (up to page_size rows)  
+                    if not self.throttle or attempt >= self.throttle.max_attempts:  
+                        raise  
+                    delay = self.throttle.backoff_delay(attempt)  
+                    self.progress.record_retry('query')  
+                    logging.warning(f"Bulk result page broke off after {offered} rows ({e}); fetching it again in {delay:.1f}s")  
+                    time.sleep(delay)  
+            locator = response.headers.get('Sforce-Locator')  
+            if not locator or locator == 'null':  
+                break  
+
+
+class OutputSink:  
+    """  
+    Where downloaded files end up. create_filename still decides each file's path under output_dir;  
+    the sink turns that path into a stored object and reports where it went (the FilePath written to  
+    the checkpoint store and metadata CSV).  
+
+    open(filename) returns a writer with write(chunk), commit() and abort(); nothing is visible under  
+    the final name until commit(). stat(filename) returns (location, size) of a stored file or None,  
+    and contains(location) checks a location recorded by an earlier run (--resume, --incremental).  
+    """  
+    supports_ranges = False  # Ranged downloads write parts at their offsets in place  
+    supports_links = False  # --dedup hardlink  
+    make_directories = False  # create_filename creates the file's folder under output_dir  
+    blocking = False  # Writes may block on network or large copies; the async engine runs them in its executor  
+    errors = ()  # Exceptions (besides OSError) of a failed write, reported as a failed download  
+    retryable_errors = ()  # Those of errors worth retrying, e.g. a dropped connection  
+
+    def open(self, filename):  
+        raise NotImplementedError  
+
+    def location(self, filename):  
+        return filename  
+
+    def stat(self, filename):  
+        raise NotImplementedError  
+
+    def contains(self, location):  
+        raise NotImplementedError  
+
+    def close(self):  
+        pass  
+
+
+class FileSystemWriter:  
+    """Writes one file to filename + '.part' and renames it into place on commit."""  
+
+    def __init__(self, filename):  
+        self.filename = filename  
+        self.temp_filename = filename + '.part'  
+        self.file_out = open(self.temp_filename, 'wb')  
+
+    def write(self, chunk):  
+        self.file_out.write(chunk)  
+
+    def commit(self):  
+        self.file_out.close()  
+        os.replace(self.temp_filename, self.filename)  
+
+    def abort(self):  
+        self.file_out.close()  
+        if os.path.exists(self.temp_filename):  
+            os.remove(self.temp_filename)  
+
+
+class FileSystemSink(OutputSink):  
+    """Every file is written to its own path under output_dir (--sink files, the default)."""  
+    supports_ranges = True  
+    supports_links = True  
+    make_directories = True  
+
+    def open(self, filename):  
+        return FileSystemWriter(filename)  
+
+    def stat(self, filename):  
+        try:  
+            return filename, os.path.getsize(filename)  
+        except OSError:  
+            return None  
+
+    def contains(self, location):  
+        return os.path.exists(location)  
+
+
+LOCAL_SINK = FileSystemSink()  
+
+
+class ArchiveWriter:  
+    """Buffers one file in a SpooledTemporaryFile and appends it to the sink's current shard on commit."""  
+
+    def __init__(self, sink, filename):  
+        self.sink = sink  
+        self.filename = filename  
+        self.spool = tempfile.SpooledTemporaryFile(max_size=sink.spool_size, dir=sink.output_directory)  
+
+    def write(self, chunk):  
+        self.spool.write(chunk)  
+
+    def commit(self):  
+        try:  
+            self.sink.append(self.filename, self.spool)  
+        finally:  
+            self.spool.close()  
+
+    def abort(self):  
+        self.spool.close()  
+
+
+class ArchiveSink(OutputSink):  
+    """  
+    Streams files into rolling zip or tar shards in output_dir (files_0001.zip, files_0002.zip, ...;  
+    files.shardK_0001.zip per --shards process) instead of millions of loose files, so no second  
+    pass is needed to pack them. Members are named by their path relative to output_dir and stored  
+    uncompressed. Each file is spooled in memory (on disk beyond spool_size bytes) while it downloads  
+    and appended when it succeeds, so a failed or retried download never leaves a partial member.  
+    A new shard is started once the current one reaches shard_size bytes. Locations are  
+    '<shard>/<member>', a path Windows Explorer can open inside a zip. The member index (member ->  
+    shard, size) lives in a temporary SQLite table in output_dir, so memory does not grow with the  
+    number of files.  
+    """  
+    blocking = True  
+
+    def __init__(self, output_directory, archive_format='zip', shard_index=None, shard_size=4294967296, spool_size=16777216):  
+        self.output_directory = output_directory  
+        self.archive_format = archive_format  
+        self.shard_size = shard_size  
+        self.spool_size = spool_size  
+        self.shard_root = os.path.splitext(shard_suffixed(os.path.join(output_directory, 'files.zip'), shard_index))[0]  
+        self.archive = None  
+        self.archive_file = None  
+        self.archive_path = None  
+        self._lock = threading.Lock()  
+        self._index_lock = threading.Lock()  
+        # Member name -> (shard number, size), including shards written by earlier runs  
+        handle, self.index_path = tempfile.mkstemp(prefix='archive_index_', suffix='.db', dir=output_directory)  
+        os.close(handle)  
+        self._index = sqlite3.connect(self.index_path, check_same_thread=False)  
+        self._index.execute('PRAGMA journal_mode=OFF')  
+        self._index.execute('PRAGMA synchronous=OFF')  
+        self._index.execute('CREATE TABLE members (Member TEXT PRIMARY KEY, Shard INTEGER, Size INTEGER) WITHOUT ROWID')  
+        self.shard_number = self._index_existing_shards()  
+
+    def shard_path(self, shard_number):  
+        return f"{self.shard_root}_{shard_number:04d}.{self.archive_format}"  
+
+    def _add_members(self, shard_number, entries):  
+        with self._index_lock:  
+            self._index.executemany('INSERT OR REPLACE INTO members VALUES (?, ?, ?)', ((member, shard_number, size) for member, size in entries))  
+
+    def _member(self, member):  
+        """Returns (location, size) of a stored member, or None."""  
+        with self._index_lock:  
+            row = self._index.execute('SELECT Shard, Size FROM members WHERE Member = ?', (member,)).fetchone()  
+        return (os.path.join(self.shard_path(row[0]), member), row[1]) if row else None  
+
+    def _index_existing_shards(self):  
+        """Indexes members of shards left by an earlier run (for --resume) and returns the last shard number."""  
+        last_number = 0  
+        for path in glob.glob(f"{glob.escape(self.shard_root)}_*.{self.archive_format}"):  
+            match = re.search(r'_(\d+)\.\w+$', path)  
+            if not match:  
+                continue  
+            shard_number = int(match.group(1))  
+            last_number = max(last_number, shard_number)  
+            try:  
+                if self.archive_format == 'zip':  
+                    with zipfile.ZipFile(path) as archive:  
+                        entries = [(info.filename, info.file_size) for info in archive.infolist()]  
+                else:  
+                    with tarfile.open(path) as archive:  
+                        entries = [(info.name, info.size) for info in archive.getmembers()]  
+            except (zipfile.BadZipFile, tarfile.TarError, OSError) as e:  
+                logging.warning(f"Ignoring unreadable archive {path} (interrupted run?): {e}")  
+                continue  
+            self._add_members(shard_number, entries)  
+        return last_number  
+
+    def member_name(self, filename):  
+        return os.path.relpath(filename, self.output_directory).replace(os.sep, '/')  
+
+    def open(self, filename):  
+        return ArchiveWriter(self, filename)  
+
+    def _close_shard(self):  
+        if self.archive:  
+            self.archive.close()  
+            self.archive_file.close()  
+            self.archive = self.archive_file = None  
+
+    def _roll(self):  
+        self._close_shard()  
+        self.shard_number += 1  
+        self.archive_path = self.shard_path(self.shard_number)  
+        self.archive_file = open(self.archive_path, 'wb')  
+        if self.archive_format == 'zip':  
+            self.archive = zipfile.ZipFile(self.archive_file, 'w', zipfile.ZIP_STORED, allowZip64=True)  
+        else:  
+            self.archive = tarfile.open(fileobj=self.archive_file, mode='w', format=tarfile.PAX_FORMAT)  
+        logging.info(f"Writing files to {self.archive_path}")  
+
+    def append(self, filename, spool):  
+        member = self.member_name(filename)  
+        size = spool.tell()  
+        spool.seek(0)  
+        with self._lock:  
+            if self.archive is None or self.archive_file.tell() >= self.shard_size:  
+                self._roll()  
+            if self.archive_format == 'zip':  
+                info = zipfile.ZipInfo(member, date_time=time.localtime()[:6])  
+                with self.archive.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as member_out:  
+                    shutil.copyfileobj(spool, member_out, 1048576)  
+            else:  
+                info = tarfile.TarInfo(member)  
+                info.size = size  
+                info.mtime = time.time()  
+                self.archive.addfile(info, spool)  
+            shard_number = self.shard_number  
+        self._add_members(shard_number, [(member, size)])  
+
+    def location(self, filename):  
+        entry = self._member(self.member_name(filename))  
+        return entry[0] if entry else filename  
+
+    def stat(self, filename):  
+        return self._member(self.member_name(filename))  
+
+    def contains(self, location):  
+        match = re.match(re.escape(self.shard_root) + r'_\d+\.' + self.archive_format + re.escape(os.sep) + r'(.+)$', location)  
+        entry = self._member(match.group(1)) if match else None  
+        return bool(entry) and entry[0] == location  
+
+    def close(self):  
+        with self._lock:  
+            self._close_shard()  
+        with self._index_lock:  
+            if self._index is not None:  
+                self._index.close()  
+                self._index = None  
+                os.remove(self.index_path)  
+
+
+class S3Writer:  
+    """Collects one file into part_size parts sent as a multipart upload; small files become one PUT on commit."""  
+
+    def __init__(self, sink, key):  
+        self.sink = sink  
+        self.key = key  
+        self.buffer = bytearray()  
+        self.upload_id = None  
+        self.parts = []  
+
+    def write(self, chunk):  
+        self.buffer += chunk  
+        if len(self.buffer) >= self.sink.part_size:  
+            self._upload_part(bytes(self.buffer[:self.sink.part_size]))  
+            del self.buffer[:self.sink.part_size]  
+
+    def _upload_part(self, body):  
+        client = self.sink.client  
+        if self.upload_id is None:  
+            self.upload_id = client.create_multipart_upload(Bucket=self.sink.bucket, Key=self.key)['UploadId']  
+        part_number = len(self.parts) + 1  
+        response = client.upload_part(Bucket=self.sink.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body)  
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})  
+
+    def commit(self):  
+        client = self.sink.client  
+        if self.upload_id is None:  
+            client.put_object(Bucket=self.sink.bucket, Key=self.key, Body=bytes(self.buffer))  
+        else:  
+            if self.buffer or not self.parts:  
+                self._upload_part(bytes(self.buffer))  
+            client.complete_multipart_upload(Bucket=self.sink.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})  
+        self.buffer = bytearray()  
+
+    def abort(self):  
+        self.buffer = bytearray()  
+        if self.upload_id is not None:  
+            try:  
+                self.sink.client.abort_multipart_upload(Bucket=self.sink.bucket, Key=self.key, UploadId=self.upload_id)  
+            except Exception as e:  
+                logging.debug(f"Could not abort multipart upload of {self.key}: {e}")  
+
+
+class S3Sink(OutputSink):  
+    """  
+    Uploads each file to an S3-compatible bucket (AWS S3, MinIO, ...) while it downloads, with no  
+    local copy: chunks are gathered into part_size parts sent as a multipart upload (parts must be at  
+    least 5 MB), and files smaller than one part are sent as a single PUT. A failed download aborts  
+    its upload. Keys are prefix + the file's path relative to output_dir; locations are s3://bucket/key.  
+    Needs boto3; credentials come from the ini or boto3's usual sources (environment, profile, role).  
+    """  
+    blocking = True  
+    errors = (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) if boto3 else ()  
+    retryable_errors = (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError) if boto3 else ()  
+
+    def __init__(self, output_directory, bucket, prefix='', endpoint_url=None, region=None, access_key=None, secret_key=None, part_size=8388608, max_connections=10):  
+        self.output_directory = output_directory  
+        self.bucket = bucket  
+        self.prefix = prefix  
+        self.part_size = max(part_size, 5242880)  
+        self.client = boto3.client(  
+            's3', endpoint_url=endpoint_url or None, region_name=region or None,  
+            aws_access_key_id=access_key or None, aws_secret_access_key=secret_key or None,  
+            config=botocore.config.Config(max_pool_connections=max_connections, s3={'addressing_style': 'path'} if endpoint_url else None)  
+        )  
+
+    def key(self, filename):  
+        return self.prefix + os.path.relpath(filename, self.output_directory).replace(os.sep, '/')  
+
+    def open(self, filename):  
+        return S3Writer(self, self.key(filename))  
+
+    def location(self, filename):  
+        return f"s3://{self.bucket}/{self.key(filename)}"  
+
+    def _head(self, bucket, key):  
+        try:  
+            return self.client.head_object(Bucket=bucket, Key=key)['ContentLength']  
+        except botocore.exceptions.ClientError as e:  
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):  
+                return None  
+            raise  
+
+    def stat(self, filename):  
+        size = self._head(self.bucket, self.key(filename))  
+        return None if size is None else (self.location(filename), size)  
+
+    def contains(self, location):  
+        if not location.startswith('s3://'):  
+            return False  
+        bucket, _, key = location[len('s3://'):].partition('/')  
+        return self._head(bucket, key) is not None  
+
+
+class CheckpointStore:  
+    """  
+    Persistent per-record download journal backed by SQLite and keyed by record Id.  
+    download_file records every outcome as soon as it is known, so a crash or restart  
+    loses at most the files that were in flight. Safe to share between worker threads.  
+    """  
+
+    def __init__(self, db_path):  
+        self.db_path = db_path  
+        self._lock = threading.Lock()  
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)  
+        self._conn.execute('PRAGMA journal_mode=WAL')  
+        self._conn.execute('PRAGMA synchronous=NORMAL')  
+        self._conn.execute(  
+            'CREATE TABLE IF NOT EXISTS checkpoint ('  
+            'Id TEXT PRIMARY KEY, Status TEXT, FilePath TEXT, Bytes INTEGER, Updated REAL, Checksum TEXT, Modstamp TEXT)'  
+        )  
+        # Checkpoints written before version fingerprints were tracked lack the last two columns  
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(checkpoint)')}  
+        for column in ('Checksum', 'Modstamp'):  
+            if column not in columns:  
+                self._conn.execute(f'ALTER TABLE checkpoint ADD COLUMN {column} TEXT')  
+
+    def record(self, record_id, status, filepath, bytes_written, checksum=None, modstamp=None):  
+        """Stores (or replaces) the latest outcome for a record, with its version fingerprint."""  
+        with self._lock:  
+            self._conn.execute(  
+                'INSERT OR REPLACE INTO checkpoint (Id, Status, FilePath, Bytes, Updated, Checksum, Modstamp) VALUES (?, ?, ?, ?, ?, ?, ?)',  
+                (record_id, status, filepath, bytes_written, time.time(), checksum, modstamp)  
+            )  
+
+    def get(self, record_id):  
+        """Returns (Status, FilePath, Bytes) for a record, or None if it was never attempted."""  
+        with self._lock:  
+            return self._conn.execute(  
+                'SELECT Status, FilePath, Bytes FROM checkpoint WHERE Id = ?', (record_id,)  
+            ).fetchone()  
+
+    def get_version(self, record_id):  
+        """Returns (Status, FilePath, Checksum, Modstamp) for a record, or None if it was never attempted."""  
+        with self._lock:  
+            return self._conn.execute(  
+                'SELECT Status, FilePath, Checksum, Modstamp FROM checkpoint WHERE Id = ?', (record_id,)  
+            ).fetchone()  
+
+    def close(self):  
+        with self._lock:  
+            self._conn.close()  
+
+
+class DedupEntry:  
+    """  
+    One piece of content claimed by the first worker that needs it. Later duplicates wait on done  
+    (threads) or DedupIndex.wait_async (asyncio, without parking a thread of the loop's executor).  
+    """  
+
+    def __init__(self, key, filename):  
+        self.key = key  
+        self.filename = filename  
+        self.status = None  
+        self.done = threading.Event()  
+        self.futures = []  # (loop, future) of asyncio waiters  
+
+
+class DedupIndex:  
+    """  
+    Detects content already downloaded in this run, keyed by ContentVersion Checksum (plus size)  
+    when selected, otherwise by the Body/VersionData URL. ContentDocumentLink exports return the  
+    same document once per linked entity; only the first copy is fetched and the rest become  
+    hardlinks ('hardlink', falling back to a local copy) or point at the first file ('reference').  
+    Once content is settled, only its (status, filename) is kept, not the entry and its event.  
+    """  
+
+    def __init__(self, mode='hardlink'):  
+        self.mode = mode  
+        self._entries = {}  
+        self._lock = threading.Lock()  
+
+    def claim(self, record, blob_url, filename):  
+        """Returns (entry, is_owner). The owner downloads and must call complete(); others wait on entry.done."""  
+        checksum, _ = get_version_fingerprint(record)  
+        key = (checksum, get_expected_size(record)) if checksum else blob_url  
+        with self._lock:  
+            entry = self._entries.get(key)  
+            if entry is None:  
+                entry = self._entries[key] = DedupEntry(key, filename)  
+                return entry, True  
+            if isinstance(entry, tuple):  # Already settled  
+                status, stored_filename = entry  
+                entry = DedupEntry(key, stored_filename)  
+                entry.status = status  
+                entry.done.set()  
+            return entry, False  
+
+    def complete(self, entry, status, filename=None):  
+        """Publishes the owner's outcome; filename is where the content was stored, if not the path it claimed."""  
+        with self._lock:  
+            entry.status = status  
+            entry.filename = filename or entry.filename  
+            entry.done.set()  
+            self._entries[entry.key] = (entry.status, entry.filename)  
+            futures, entry.futures = entry.futures, []  
+        for loop, future in futures:  
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))  
+
+    async def wait_async(self, entry):  
+        """Waits on the running loop until the owner of entry completes."""  
+        with self._lock:  
+            if entry.done.is_set():  
+                return  
+            loop = asyncio.get_running_loop()  
+            future = loop.create_future()  
+            entry.futures.append((loop, future))  
+        await future  
+
+    def reuse(self, entry, filename):  
+        """  
+        Materializes a duplicate from the owner's finished download.  
+
+        Returns:  
+            tuple: (status, filepath), or None if the owner failed and the duplicate must be downloaded.  
+        """  
+        if not (entry.status or '').startswith('Success'):  
+            return None  
+        if self.mode == 'reference':  
+            return 'Success (Duplicate Reference)', entry.filename  
+        if entry.filename != filename:  
+            try:  
+                if os.path.exists(filename):  
+                    os.remove(filename)  
+                try:  
+                    os.link(entry.filename, filename)  
+                except OSError:  # e.g. file systems without hardlinks  
+                    shutil.copyfile(entry.filename, filename)  
+            except OSError as e:  
+                logging.debug(f"Could not reuse {entry.filename} for {filename}: {e}")  
+                return None  
+        return 'Success (Deduplicated)', filename  
+
+
+def get_expected_size(record):  
+    """Returns the file size Salesforce reports for the record (BodyLength/ContentSize), or None if not selected."""  
+    for field_path in SIZE_FIELD_PATHS:  
+        size = get_nested_field(record, field_path)  
+        if size is not None:  
+            try:  
+                return int(size)  
+            except (TypeError, ValueError):  
+                return None  
+    return None  
+
+
+def get_version_fingerprint(record):  
+    """Returns (Checksum, SystemModstamp) of the record's file version; either may be None if not selected."""  
+    checksum = next((value for value in (get_nested_field(record, path) for path in CHECKSUM_FIELD_PATHS) if value), None)  
+    modstamp = next((value for value in (get_nested_field(record, path) for path in MODSTAMP_FIELD_PATHS) if value), None)  
+    return checksum, modstamp  
+
+
+def find_unchanged(prior_checkpoint, record, sink=LOCAL_SINK):  
+    """  
+    Incremental sync: returns the file path from a prior run if that run downloaded the same version  
+    of this record (same Checksum, or same SystemModstamp if no checksum) and the file is still in the sink.  
+    """  
+    entry = prior_checkpoint.get_version(record.get('Id'))  
+    if not entry:  
+        return None  
+    status, filepath, prior_checksum, prior_modstamp = entry  
+    if not (status or '').startswith('Success'):  
+        return None  
+    checksum, modstamp = get_version_fingerprint(record)  
+    if checksum and prior_checksum:  
+        unchanged = checksum == prior_checksum  
+    elif modstamp and prior_modstamp:  
+        unchanged = modstamp == prior_modstamp  
+    else:  
+        return None  
+    return filepath if unchanged and filepath and sink.contains(filepath) else None  
+
+
+def resolve_skip(record, filename, blob_url, missing_status, checkpoint, resume, prior_checkpoint, sink=LOCAL_SINK):  
+    """  
+    Decides whether a record can be settled without downloading it.  
+
+    Returns:  
+        tuple: (status, filepath), or None if the file has to be downloaded.  
+    """  
+    resumed = find_downloaded(checkpoint, record, filename, sink) if resume and checkpoint else None  
+    if resumed:  
+        logging.debug(f"Skipping {filename}: already downloaded by a previous run")  
+        return resumed  
+    if prior_checkpoint:  
+        prior_filepath = find_unchanged(prior_checkpoint, record, sink)  
+        if prior_filepath:  
+            logging.debug(f"Skipping {filename}: unchanged since the prior run ({prior_filepath})")  
+            return 'Success (Unchanged)', prior_filepath  
+    if not blob_url:  
+        return missing_status, filename  
+    return None  
+
+
+def find_downloaded(checkpoint, record, filename, sink=LOCAL_SINK):  
+    """  
+    Checks whether a previous run already downloaded this record completely.  
+    The checkpoint must report Success for the same location, and the stored file must match  
+    BodyLength/ContentSize (or the byte count recorded at the time, if no size field was selected).  
+    Rows that --dedup reference pointed at another record's copy never had a file of their own;  
+    they are settled as long as that copy is still stored.  
+
+    Returns:  
+        tuple: (status, filepath) to record for the resumed row, or None if it must be downloaded.  
+    """  
+    entry = checkpoint.get(record.get('Id'))  
+    if not entry:  
+        return None  
+    status, filepath, bytes_written = entry  
+    if not status.startswith('Success'):  
+        return None  
+    if status == 'Success (Duplicate Reference)':  
+        return (status, filepath) if filepath and sink.contains(filepath) else None  
+    stored = sink.stat(filename)  
+    if not stored or stored[0] != filepath:  
+        return None  
+    on_disk_size = stored[1]  
+    expected_size = get_expected_size(record)  
+    if expected_size is None:  
+        expected_size = bytes_written  
+    return ('Success (Resumed)', filepath) if on_disk_size == expected_size else None  
+
+
+def stream_to_file(response, filename, chunk_size, sink=LOCAL_SINK):  
+    """  
+    Streams a response body to the output sink in fixed-size chunks so memory per worker stays bounded.  
+    With the default FileSystemSink, data is written to a temporary '.part' file and atomically renamed  
+    into place on success, so an interrupted transfer never leaves a truncated file under the final name.  
+
+    Args:  
+        response (requests.Response): Response opened with stream=True.  
+        filename (str): Final destination path.  
+        chunk_size (int): Number of bytes read from the socket per write.  
+        sink (OutputSink): Destination of the bytes (default: the local file system).  
+
+    Returns:  
+        int: Number of bytes written.  
+    """  
+    writer = sink.open(filename)  
+    bytes_written = 0  
+    try:  
+        for chunk in response.iter_content(chunk_size=chunk_size):  
+            if chunk:  
+                writer.write(chunk)  
+                bytes_written += len(chunk)  
+        writer.commit()  
+    except BaseException:  
+        writer.abort()  
+        raise  
+    return bytes_written  
+
+
+def stream_to_range(response, filename, byte_range, chunk_size):  
+    """  
+    Streams a 206 Partial Content body into its slot of a preallocated file (see fetch_blob_ranged).  
+    A body shorter or longer than the requested range raises ChunkedEncodingError, so the range is retried.  
+
+    Returns:  
+        int: Number of bytes written.  
+    """  
+    start, end = byte_range  
+    expected = end - start + 1  
+    bytes_written = 0  
+    with open(filename, 'r+b') as file_out:  
+        file_out.seek(start)  
+        for chunk in response.iter_content(chunk_size=chunk_size):  
+            if chunk:  
+                if bytes_written + len(chunk) > expected:  
+                    raise requests.exceptions.ChunkedEncodingError(f"Range {start}-{end} returned more than {expected} bytes")  
+                file_out.write(chunk)  
+                bytes_written += len(chunk)  
+    if bytes_written != expected:  
+        raise requests.exceptions.ChunkedEncodingError(f"Range {start}-{end} returned {bytes_written} of {expected} bytes")  
+    return bytes_written  
+
+
+# Status of a range request answered with the whole file; the download falls back to a single stream  
+RANGE_NOT_SUPPORTED_STATUS = 'Failed (Range not supported)'  
+
+
+class RangedDownloadPlan:  
+    """  
+    Decides which files are fetched as parallel HTTP Range requests: files of at least threshold  
+    bytes (by BodyLength/ContentSize) are cut into part_size ranges, up to connections of them in  
+    flight per file. Every range request still goes through the shared RequestThrottle.  
+    """  
+
+    def __init__(self, threshold, part_size=67108864, connections=4):  
+        self.threshold = threshold  
+        self.part_size = max(part_size, 1)  
+        self.connections = max(connections, 1)  
+
+    def ranges(self, expected_size):  
+        """Returns the (start, end) byte ranges (inclusive) for a file, or None to download it in one request."""  
+        if not self.threshold or not expected_size or expected_size < self.threshold or expected_size <= self.part_size:  
+            return None  
+        return [(start, min(start + self.part_size, expected_size) - 1) for start in range(0, expected_size, self.part_size)]  
+
+
+def verify_download(filename, expected_size, checksum, chunk_size):  
+    """  
+    Checks an assembled file against the size and, when selected, the ContentVersion Checksum (MD5 hex).  
+
+    Returns:  
+        str: A failure status, or None if the file matches.  
+    """  
+    on_disk_size = os.path.getsize(filename)  
+    if on_disk_size != expected_size:  
+        return f"Failed (Size mismatch: {on_disk_size} of {expected_size} bytes)"  
+    if checksum:  
+        digest = hashlib.md5()  
+        with open(filename, 'rb') as file_in:  
+            for block in iter(lambda: file_in.read(chunk_size), b''):  
+                digest.update(block)  
+        if digest.hexdigest() != checksum.lower():  
+            return 'Failed (Checksum mismatch)'  
+    return None  
+
+
+def schedule_records(records, schedule='fifo', lookahead=1000):  
+    """  
+    Orders the record stream for download using BodyLength/ContentSize to cut the long-tail makespan.  
+    Because records arrive as a stream, ordering is applied over a sliding window of lookahead records.  
+
+    Args:  
+        records (iterable): Records in query order.  
+        schedule (str): 'fifo' (query order), 'largest-first' (start big files early so they do not  
+            finish last), or 'interleave' (alternate largest and smallest to mix long and short transfers).  
+        lookahead (int): Number of records buffered for reordering.  
+
+    Yields:  
+        dict: Records in scheduled order.  
+    """  
+    if schedule == 'fifo':  
+        yield from records  
+        return  
+
+    window = []  # Sorted by (size, arrival) so the largest is at the end and the smallest at the front  
+    take_largest = True  
+    for sequence, record in enumerate(records):  
+        bisect.insort(window, (get_expected_size(record) or 0, sequence, record))  # sequence is unique, so records are never compared  
+        if len(window) >= lookahead:  
+            yield window.pop(-1 if take_largest else 0)[2]  
+            take_largest = take_largest if schedule == 'largest-first' else not take_largest  
+    while window:  
+        yield window.pop(-1 if take_largest else 0)[2]  
+        take_largest = take_largest if schedule == 'largest-first' else not take_largest  
+
+
+def instance_url(sf):  
+    """  
+    Returns the scheme and host blob URLs are resolved against. simple_salesforce always talks https  
+    to sf_instance; a stand-in client (e.g. Benchmark.py's mock org) may provide its own instance_url.  
+    """  
+    return getattr(sf, 'instance_url', None) or f"https://{sf.sf_instance}"  
+
+
+def prepare_download(record, output_directory, filename_pattern, projection, salesforce_object, sink=LOCAL_SINK):  
+    """  
+    Resolves everything about a record that does not depend on the HTTP engine.  
+
+    Returns:  
+        tuple: (filename, illegal_mask, blob_url, missing_status) where blob_url is None when the  
+        record has no Body/VersionData URL and missing_status is the status to report in that case.  
+    """  
+    indexed_fields = [value or 'Unknown' for value in projection.field_values(record)]  
+    if salesforce_object == 'attachment':  
+        title = record.get('Name') or 'NoTitle'  
+        content_type = record.get('ContentType') or 'application/octet-stream'  
+        file_extension = content_type.split('/')[-1]  # minimal way to guess extension from MIME type  
+    else:  
+        title = record.get('Title') or 'NoTitle'  
+        file_extension = record.get('FileExtension') or ''   
+  
+    # Create sanitized filename and illegal chars mask  
+    filename, illegal_mask = create_filename(title, file_extension, output_directory, filename_pattern, indexed_fields, sink.make_directories)  
+
+    # Resolve the blob URL for the record; Attachment bodies and ContentVersion data share one download path
+    if salesforce_object == 'attachment':  
+        blob_url = record.get('Body')  
+        missing_status = 'Failed (No Body URL)'  
+    else:  
+        blob_url = next((url for url in (get_nested_field(record, path) for path in VERSION_DATA_FIELD_PATHS) if url), None)  
+        missing_status = 'Failed (No VersionData URL)'  
+
+    return filename, illegal_mask, blob_url, missing_status  
+
+
+def finish_download(record, filename, illegal_mask, status, bytes_written, metadata_writer, checkpoint, progress):  
+    """Records the outcome of one file in the checkpoint store, the metadata CSV writer and the progress display."""  
+    # Persist the outcome right away so an interrupted run can resume from here  
+    if checkpoint and status != 'Success (Resumed)':  
+        checksum, modstamp = get_version_fingerprint(record)  
+        checkpoint.record(record.get('Id'), status, filename, bytes_written, checksum, modstamp)  
+
+    # Hand the finished row to the writer stage (no lock, no CSV write here!)  
+    file_name_only = os.path.basename(filename)  
+    xls_hyperlink = f'=HYPERLINK("{filename}", "{file_name_only}")'  
+    metadata_writer.complete(record.get('Id'), [filename, xls_hyperlink, status, illegal_mask])  
+  
+    # Thread-safe update of progress and metrics  
+    progress.advance(status, bytes_written, get_expected_size(record))  
+
+
+class MetadataWriter:  
+    """  
+    Writer stage for files_metadata.csv. Workers hand finished rows over through a queue instead of  
+    taking a shared lock; a background thread appends them in batches to a journal next to the CSV  
+    (files_metadata.csv.journal), flushing every batch and fsyncing every fsync_interval seconds, so  
+    partial results are always on disk and memory does not grow with the row count.  
+
+    Rows reach the journal in completion order, tagged with their submission sequence. close() restores  
+    submission order with an external merge sort (sorted runs of MERGE_RUN_ROWS rows, then a k-way merge)  
+    and writes the final CSV.  
+    """  
+    BATCH_ROWS = 500  
+    MERGE_RUN_ROWS = 50000  
+    DEFAULT_FILE_COLUMNS = ['Not Created', 'N/a', 'Failed', 'N/a']  
+    _DONE = object()  
+
+    def __init__(self, results_path, metadata_header, projection, metadata_field_indexes, fsync_interval=5.0, max_queued=10000):  
+        self.results_path = results_path  
+        self.journal_path = results_path + '.journal'  
+        self.metadata_header = metadata_header  
+        self.projection = projection  
+        self.metadata_field_indexes = metadata_field_indexes  
+        self.fsync_interval = fsync_interval  
+        self.queue = queue.Queue(maxsize=max_queued)  
+        self.rows_written = 0  
+        self.error = None  
+        # Id -> (sequence, metadata columns) of records submitted but not finished; bounded by the download window  
+        self._pending = {}  
+        self._sequence = itertools.count()  
+        self._thread = threading.Thread(target=self._run, name='MetadataWriter', daemon=True)  
+
+    def start(self):  
+        self._thread.start()  
+        return self  
+
+    def register(self, record):  
+        """Registers a record as it is submitted for download; it is reported as failed if it never finishes."""  
+        record_id = record.get('Id')  
+        if record_id not in self._pending:  
+            fields = self.projection.field_values(record)  
+            columns = [fields[idx - 1] or '' for idx in self.metadata_field_indexes]  
+            self._pending[record_id] = (next(self._sequence), columns)  
+
+    def complete(self, record_id, file_columns):  
+        """Queues the finished row of a registered record (FilePath, XLS link, Status, illegal chars mask)."""  
+        entry = self._pending.pop(record_id, None)  
+        if entry:  
+            self.queue.put((entry[0], entry[1] + file_columns))  
+
+    def _run(self):  
+        done = False  
+        last_sync = time.monotonic()  
+        try:  
+            with open(self.journal_path, 'w', encoding='utf-8', newline='') as f_journal:  
+                writer = csv.writer(f_journal)  
+                while not done:  
+                    batch = [self.queue.get()]  
+                    # Drain whatever else is already queued so rows are written in batches  
+                    while len(batch) < self.BATCH_ROWS:  
+                        try:  
+                            batch.append(self.queue.get_nowait())  
+                        except queue.Empty:  
+                            break  
+                    if batch[-1] is self._DONE:  
+                        batch.pop()  
+                        done = True  
+                    if self.error:  
+                        continue  # Keep draining so workers never block on a full queue  
+                    try:  
+                        writer.writerows([sequence] + columns for sequence, columns in batch)  
+                        self.rows_written += len(batch)  
+                        f_journal.flush()  
+                        if done or time.monotonic() - last_sync >= self.fsync_interval:  
+                            os.fsync(f_journal.fileno())  
+                            last_sync = time.monotonic()  
+                    except OSError as e:  
+                        self.error = e  
+                        logging.error(f"Could not write metadata journal {self.journal_path}: {e}")  
+        except OSError as e:  
+            self.error = e  
+            logging.error(f"Could not open metadata journal {self.journal_path}: {e}")  
+            while not done:  
+                done = self.queue.get() is self._DONE  
+
+    def close(self):  
+        """Reports unfinished records as failed, drains the queue and merges the journal into files_metadata.csv."""  
+        for sequence, columns in sorted(self._pending.values()):  
+            self.queue.put((sequence, columns + self.DEFAULT_FILE_COLUMNS))  
+        self._pending.clear()  
+        self.queue.put(self._DONE)  
+        self._thread.join()  
+        if self.error:  
+            logging.error(f"files_metadata.csv was not written; partial rows remain in {self.journal_path}")  
+            return  
+        self._merge()  
+        os.remove(self.journal_path)  
+
+    def _merge(self):  
+        sequence_key = lambda row: int(row[0])  
+        in_memory_runs = []  
+        run_paths = []  
+        run_files = []  
+        try:  
+            with open(self.journal_path, 'r', encoding='utf-8', newline='') as f_journal:  
+                reader = csv.reader(f_journal)  
+                for run in iter(lambda: list(itertools.islice(reader, self.MERGE_RUN_ROWS)), []):  
+                    run.sort(key=sequence_key)  
+                    if not run_paths and len(run) < self.MERGE_RUN_ROWS:  
+                        in_memory_runs.append(run)  # The whole journal fits in one run  
+                        break  
+                    run_path = f"{self.journal_path}.run{len(run_paths)}"  
+                    with open(run_path, 'w', encoding='utf-8', newline='') as f_run:  
+                        csv.writer(f_run).writerows(run)  
+                    run_paths.append(run_path)  
+            run_files = [open(run_path, 'r', encoding='utf-8', newline='') for run_path in run_paths]  
+
+            temp_path = self.results_path + '.tmp'  
+            with open(temp_path, 'w', encoding='utf-8', newline='') as f_csv:  
+                writer = csv.writer(f_csv)  
+                writer.writerow(self.metadata_header)  
+                writer.writerows(row[1:] for row in heapq.merge(*in_memory_runs, *(csv.reader(f_run) for f_run in run_files), key=sequence_key))  
+            os.replace(temp_path, self.results_path)  
+        finally:  
+            for f_run in run_files:  
+                f_run.close()  
+            for run_path in run_paths:  
+                os.remove(run_path)  
+        logging.info(f"Wrote {self.rows_written} rows to {self.results_path}")  
+
+
+def fetch_blob(session, url, filename, chunk_size, throttle, progress=None, byte_range=None, sink=LOCAL_SINK, auth=None):  
+    """  
+    Downloads one blob to filename, retrying timeouts, connection resets and throttled or transient  
+    HTTP responses with jittered exponential backoff. Every attempt goes through the shared circuit  
+    breaker and adaptive concurrency limit, and is counted in progress' metrics when given.  
+    With byte_range (start, end), only that range is requested and written into the preallocated  
+    filename at its offset; per-file latency is then left to fetch_blob_ranged. Whole files go to sink.  
+    The session carries the Authorization header; on a 401 the session is renewed through auth and  
+    the request repeated right away.  
+
+    Returns:  
+        tuple: (status, bytes_written)  
+    """  
+    file_started = None  # Per-file latency runs from the first request slot, including retries  
+    attempt = 0  
+    while True:  
+        attempt += 1  
+        wait = throttle.breaker.wait_time()  
+        while wait > 0:  
+            time.sleep(wait)  
+            wait = throttle.breaker.wait_time()  
+
+        if auth:  
+            auth.ensure_fresh()  
+        token = auth.token if auth else None  
+
+        status = 'Not Attempted'  
+        bytes_written = 0  
+        retryable = throttled = expired = False  
+        retry_after = None  
+        response_code = 'error'  # Until a response arrives  
+        throttle.limiter.acquire()  
+        file_started = file_started or time.perf_counter()  
+        try:  
+            started = time.perf_counter()  
+            headers = {"Content-Type": "application/octet-stream"}  
+            if byte_range:  
+                headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"  
+            with session.get(url, headers=headers, timeout=600, stream=True) as response:  
+                response_code = response.status_code  
+                if response.ok and byte_range and response.status_code != 206:  
+                    status = RANGE_NOT_SUPPORTED_STATUS  
+                elif response.ok:  
+                    bytes_written = stream_to_range(response, filename, byte_range, chunk_size) if byte_range else stream_to_file(response, filename, chunk_size, sink)  
+                    status = 'Success'  
+                    elapsed = max(time.perf_counter() - started, 1e-6)  
+                    logging.debug(f"Downloaded {filename}: {bytes_written} bytes in {elapsed:.2f}s ({bytes_written / elapsed / 1048576:.2f} MB/s)")  
+                else:  
+                    status = f"Failed (HTTP {response.status_code})"  
+                    expired = response.status_code == 401  
+                    # Read the short error body of every failure, so the connection goes back to the pool for the retry  
+                    retryable, throttled = classify_http_failure(response.status_code, response.text)  
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))  
+
+        except requests.exceptions.RequestException as e:  
+            status = f"Failed (Exception: {str(e)})"  
+            retryable = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError))  
+        except sink.errors as e:  
+            status = f"Failed (Exception: {str(e) or type(e).__name__})"  
+            retryable = isinstance(e, sink.retryable_errors)  
+        except OSError as e:  
+            status = f"Failed (Exception: {str(e)})"  
+        finally:  
+            throttle.limiter.release(throttled)  
+        if progress:  
+            progress.record_response(response_code)  
+
+        if status == 'Success':  
+            throttle.breaker.record_success()  
+            if progress and not byte_range:  
+                progress.observe_latency(time.perf_counter() - file_started)  
+            return status, bytes_written  
+        if expired and auth and attempt < throttle.max_attempts and auth.refresh(token):  
+            continue  # Session renewed (by this or another worker): repeat at once, without backoff  
+        if retryable:  
+            throttle.breaker.record_failure()  
+        if not retryable or attempt >= throttle.max_attempts:  
+            if attempt > 1:  
+                status = f"{status[:-1]} after {attempt} attempts)"  
+            return status, 0  
+        delay = throttle.backoff_delay(attempt, retry_after)  
+        if progress:  
+            progress.record_retry()  
+        logging.debug(f"{status} for {url}; retrying in {delay:.1f}s (attempt {attempt}/{throttle.max_attempts})")  
+        time.sleep(delay)  
+
+
+def fetch_blob_ranged(session, url, filename, ranges, checksum, chunk_size, throttle, connections, progress=None, auth=None):  
+    """  
+    Downloads one large blob as parallel HTTP Range requests into a preallocated '.part' file  
+    (sparse where the file system supports it). Each range is fetched and retried on its own by  
+    fetch_blob, so a failed range never restarts the whole file. The assembled file is checked  
+    against the expected size and the Checksum (when selected) before it is renamed into place.  
+    Falls back to a single streamed request if the server ignores the Range header.  
+
+    Returns:  
+        tuple: (status, bytes_written)  
+    """  
+    file_started = time.perf_counter()  
+    size = ranges[-1][1] + 1  
+    temp_filename = filename + '.part'  
+    try:  
+        with open(temp_filename, 'wb') as file_out:  
+            file_out.truncate(size)  
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(connections, len(ranges))) as executor:  
+            outcomes = list(executor.map(lambda byte_range: fetch_blob(session, url, temp_filename, chunk_size, throttle, progress, byte_range, auth=auth), ranges))  
+        if any(status == RANGE_NOT_SUPPORTED_STATUS for status, _ in outcomes):  
+            logging.debug(f"Range requests not supported for {url}; downloading {filename} in one stream")  
+            os.remove(temp_filename)  
+            return fetch_blob(session, url, filename, chunk_size, throttle, progress, auth=auth)  
+        status = next((status for status, _ in outcomes if status != 'Success'), None) or verify_download(temp_filename, size, checksum, chunk_size)  
+        if status:  
+            return status, 0  
+        os.replace(temp_filename, filename)  
+    except OSError as e:  
+        return f"Failed (Exception: {str(e)})", 0  
+    finally:  
+        if os.path.exists(temp_filename):  
+            os.remove(temp_filename)  
+    elapsed = max(time.perf_counter() - file_started, 1e-6)  
+    logging.debug(f"Downloaded {filename}: {size} bytes in {len(ranges)} ranges in {elapsed:.2f}s ({size / elapsed / 1048576:.2f} MB/s)")  
+    if progress:  
+        progress.observe_latency(elapsed)  
+    return 'Success', size  
+
+
+def download_file(args):  
+    record, output_directory, sf, filename_pattern, metadata_field_indexes, progress, projection, session, salesforce_object, metadata_writer, chunk_size, checkpoint, resume, throttle, dedup, prior_checkpoint, ranged, sink, auth = args      
+  
+    filename, illegal_mask, blob_url, missing_status = prepare_download(record, output_directory, filename_pattern, projection, salesforce_object, sink)  
+  
+    status = 'Not Attempted'  
+    bytes_written = 0  
+
+    try:  
+        skip = resolve_skip(record, filename, blob_url, missing_status, checkpoint, resume, prior_checkpoint, sink)  
+        if skip:  
+            status, filename = skip  
+        else:  
+            entry, is_owner = dedup.claim(record, blob_url, filename) if dedup else (None, True)  
+            reused = None  
+            if not is_owner:  
+                entry.done.wait()  # The owner is already running, so this cannot deadlock the pool  
+                reused = dedup.reuse(entry, filename)  
+            if reused:  
+                status, filename = reused  
+            else:  
+                url = f"{instance_url(sf)}{blob_url}"  
+                ranges = ranged.ranges(get_expected_size(record)) if ranged else None  
+                try:  
+                    if ranges:  
+                        checksum, _ = get_version_fingerprint(record)  
+                        status, bytes_written = fetch_blob_ranged(session, url, filename, ranges, checksum, chunk_size, throttle, ranged.connections, progress, auth)  
+                    else:  
+                        status, bytes_written = fetch_blob(session, url, filename, chunk_size, throttle, progress, sink=sink, auth=auth)  
+                    if status == 'Success':  
+                        filename = sink.location(filename)  
+                finally:  
+                    if entry and is_owner:  
+                        dedup.complete(entry, status, filename)  
+    except Exception as e:  
+        # Anything unexpected still settles the record: checkpoint row, metadata row and progress  
+        logging.error(f"Unexpected error while downloading {filename}: {e!r}")  
+        status, bytes_written = f"Failed (Exception: {str(e) or type(e).__name__})", 0  
+
+    finish_download(record, filename, illegal_mask, status, bytes_written, metadata_writer, checkpoint, progress)  
+
+
+async def stream_to_file_async(response, filename, chunk_size, sink=LOCAL_SINK):  
+    """  
+    aiohttp counterpart of stream_to_file: chunked writes to the sink, committed on success. Writes  
+    to blocking sinks (archive shards, S3 uploads) run in the default executor to keep the loop free.  
+    """  
+    loop = asyncio.get_running_loop()  
+    writer = sink.open(filename)  
+    bytes_written = 0  
+    try:  
+        async for chunk in response.content.iter_chunked(chunk_size):  
+            if sink.blocking:  
+                await loop.run_in_executor(None, writer.write, chunk)  
+            else:  
+                writer.write(chunk)  
+            bytes_written += len(chunk)  
+        if sink.blocking:  
+            await loop.run_in_executor(None, writer.commit)  
+        else:  
+            writer.commit()  
+    except BaseException:  
+        writer.abort()  
+        raise  
+    return bytes_written  
+
+
+async def stream_to_range_async(response, filename, byte_range, chunk_size):  
+    """aiohttp counterpart of stream_to_range: writes a 206 body at its offset, raising ClientPayloadError if it is not exactly the range."""  
+    start, end = byte_range  
+    expected = end - start + 1  
+    bytes_written = 0  
+    with open(filename, 'r+b') as file_out:  
+        file_out.seek(start)  
+        async for chunk in response.content.iter_chunked(chunk_size):  
+            if bytes_written + len(chunk) > expected:  
+                raise aiohttp.ClientPayloadError(f"Range {start}-{end} returned more than {expected} bytes")  
+            file_out.write(chunk)  
+            bytes_written += len(chunk)  
+    if bytes_written != expected:  
+        raise aiohttp.ClientPayloadError(f"Range {start}-{end} returned {bytes_written} of {expected} bytes")  
+    return bytes_written  
+
+
+async def fetch_blob_async(session, url, filename, chunk_size, throttle, progress=None, byte_range=None, sink=LOCAL_SINK, auth=None):  
+    """asyncio counterpart of fetch_blob, with the same retry, circuit breaker, concurrency, metrics, byte_range, sink and session renewal rules."""  
+    loop = asyncio.get_running_loop()  
+    file_started = None  # From the first request slot, so the tasks queued in the download window are not timed waiting for it  
+    attempt = 0  
+    while True:  
+        attempt += 1  
+        wait = throttle.breaker.wait_time()  
+        while wait > 0:  
+            await asyncio.sleep(wait)  
+            wait = throttle.breaker.wait_time()  
+        await throttle.limiter.acquire_async()  
+        file_started = file_started or time.perf_counter()  
+        if auth and auth.due():  
+            await loop.run_in_executor(None, auth.ensure_fresh)  # Logging in blocks  
+        token = auth.token if auth else None  
+
+        status = 'Not Attempted'  
+        bytes_written = 0  
+        retryable = throttled = expired = False  
+        retry_after = None  
+        response_code = 'error'  # Until a response arrives  
+        try:  
+            started = time.perf_counter()  
+            headers = {"Content-Type": "application/octet-stream"}  
+            if byte_range:  
+                headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"  
+            async with session.get(url, headers=headers) as response:  
+                response_code = response.status  
+                if response.status < 400 and byte_range and response.status != 206:  
+                    status = RANGE_NOT_SUPPORTED_STATUS  
+                elif response.status < 400:  
+                    bytes_written = await (stream_to_range_async(response, filename, byte_range, chunk_size) if byte_range else stream_to_file_async(response, filename, chunk_size, sink))  
+                    status = 'Success'  
+                    elapsed = max(time.perf_counter() - started, 1e-6)  
+                    logging.debug(f"Downloaded {filename}: {bytes_written} bytes in {elapsed:.2f}s ({bytes_written / elapsed / 1048576:.2f} MB/s)")  
+                else:  
+                    status = f"Failed (HTTP {response.status})"  
+                    expired = response.status == 401  
+                    # Read the short error body of every failure, so the connection goes back to the pool for the retry  
+                    retryable, throttled = classify_http_failure(response.status, await response.text(errors='replace'))  
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))  
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:  
+            status = f"Failed (Exception: {str(e) or type(e).__name__})"  
+            retryable = True  
+        except sink.errors as e:  
+            status = f"Failed (Exception: {str(e) or type(e).__name__})"  
+            retryable = isinstance(e, sink.retryable_errors)  
+        except OSError as e:  
+            status = f"Failed (Exception: {str(e)})"  
+        finally:  
+            throttle.limiter.release(throttled)  
+        if progress:  
+            progress.record_response(response_code)  
+
+        if status == 'Success':  
+            throttle.breaker.record_success()  
+            if progress and not byte_range:  
+                progress.observe_latency(time.perf_counter() - file_started)  
+            return status, bytes_written  
+        if expired and auth and attempt < throttle.max_attempts and await loop.run_in_executor(None, auth.refresh, token):  
+            continue  
+        if retryable:  
+            throttle.breaker.record_failure()  
+        if not retryable or attempt >= throttle.max_attempts:  
+            if attempt > 1:  
+                status = f"{status[:-1]} after {attempt} attempts)"  
+            return status, 0  
+        delay = throttle.backoff_delay(attempt, retry_after)  
+        if progress:  
+            progress.record_retry()  
+        logging.debug(f"{status} for {url}; retrying in {delay:.1f}s (attempt {attempt}/{throttle.max_attempts})")  
+        await asyncio.sleep(delay)  
+
+
+async def fetch_blob_ranged_async(session, url, filename, ranges, checksum, chunk_size, throttle, connections, progress=None, auth=None):  
+    """asyncio counterpart of fetch_blob_ranged: up to connections ranges in flight, verified off the event loop."""  
+    file_started = time.perf_counter()  
+    size = ranges[-1][1] + 1  
+    temp_filename = filename + '.part'  
+    slots = asyncio.Semaphore(connections)  
+
+    async def fetch_range(byte_range):  
+        async with slots:  
+            return await fetch_blob_async(session, url, temp_filename, chunk_size, throttle, progress, byte_range, auth=auth)  
+
+    try:  
+        with open(temp_filename, 'wb') as file_out:  
+            file_out.truncate(size)  
+        outcomes = await asyncio.gather(*(fetch_range(byte_range) for byte_range in ranges))  
+        if any(status == RANGE_NOT_SUPPORTED_STATUS for status, _ in outcomes):  
+            logging.debug(f"Range requests not supported for {url}; downloading {filename} in one stream")  
+            os.remove(temp_filename)  
+            return await fetch_blob_async(session, url, filename, chunk_size, throttle, progress, auth=auth)  
+        status = next((status for status, _ in outcomes if status != 'Success'), None)  
+        if not status:  
+            status = await asyncio.get_running_loop().run_in_executor(None, verify_download, temp_filename, size, checksum, chunk_size)  
+        if status:  
+            return status, 0  
+        os.replace(temp_filename, filename)  
+    except OSError as e:  
+        return f"Failed (Exception: {str(e)})", 0  
+    finally:  
+        if os.path.exists(temp_filename):  
+            os.remove(temp_filename)  
+    elapsed = max(time.perf_counter() - file_started, 1e-6)  
+    logging.debug(f"Downloaded {filename}: {size} bytes in {len(ranges)} ranges in {elapsed:.2f}s ({size / elapsed / 1048576:.2f} MB/s)")  
+    if progress:  
+        progress.observe_latency(elapsed)  
+    return 'Success', size  
+
+
+async def download_file_async(args):  
+    """  
+    asyncio counterpart of download_file, taking the same argument tuple with an aiohttp.ClientSession  
+    in place of the requests session. Filenames, metadata rows and statuses match the threaded path.  
+    """  
+    record, output_directory, sf, filename_pattern, metadata_field_indexes, progress, projection, session, salesforce_object, metadata_writer, chunk_size, checkpoint, resume, throttle, dedup, prior_checkpoint, ranged, sink, auth = args  
+
+    filename, illegal_mask, blob_url, missing_status = prepare_download(record, output_directory, filename_pattern, projection, salesforce_object, sink)  
+
+    status = 'Not Attempted'  
+    bytes_written = 0  
+
+    try:  
+        skip = resolve_skip(record, filename, blob_url, missing_status, checkpoint, resume, prior_checkpoint, sink)  
+        if skip:  
+            status, filename = skip  
+        else:  
+            entry, is_owner = dedup.claim(record, blob_url, filename) if dedup else (None, True)  
+            reused = None  
+            if not is_owner:  
+                await dedup.wait_async(entry)  
+                reused = dedup.reuse(entry, filename)  
+            if reused:  
+                status, filename = reused  
+            else:  
+                url = f"{instance_url(sf)}{blob_url}"  
+                ranges = ranged.ranges(get_expected_size(record)) if ranged else None  
+                try:  
+                    if ranges:  
+                        checksum, _ = get_version_fingerprint(record)  
+                        status, bytes_written = await fetch_blob_ranged_async(session, url, filename, ranges, checksum, chunk_size, throttle, ranged.connections, progress, auth)  
+                    else:  
+                        status, bytes_written = await fetch_blob_async(session, url, filename, chunk_size, throttle, progress, sink=sink, auth=auth)  
+                    if status == 'Success':  
+                        filename = sink.location(filename)  
+                finally:  
+                    if entry and is_owner:  
+                        dedup.complete(entry, status, filename)  
+    except Exception as e:  
+        # Anything unexpected still settles the record: checkpoint row, metadata row and progress  
+        logging.error(f"Unexpected error while downloading {filename}: {e!r}")  
+        status, bytes_written = f"Failed (Exception: {str(e) or type(e).__name__})", 0  
+
+    finish_download(record, filename, illegal_mask, status, bytes_written, metadata_writer, checkpoint, progress)  
+
+
+def fetch_files(sf, results, output_directory, filename_pattern, metadata_field_indexes, batch_size, thread_count, projection, salesforce_object, metadata_writer, progress, chunk_size=1048576, checkpoint=None, resume=False, max_connections=None, schedule='fifo', throttle=None, dedup=None, prior_checkpoint=None, profiler=None, ranged=None, sink=LOCAL_SINK, auth=None):    
+    """  
+    Downloads every record yielded by results (a RecordStream or any iterable of records) on one  
+    continuously fed thread pool, handing each finished row to metadata_writer. A worker slot is refilled  
+    as soon as any download completes; batch_size only caps how many records are queued or in flight.  
+    """  
+    window = threading.BoundedSemaphore(max(batch_size, thread_count))  
+    throttle = throttle or RequestThrottle(thread_count)  
+    auth = auth or SessionManager(sf)  
+    worker = profiler.wrap(download_file) if profiler else download_file  
+
+    def release_slot(future):  
+        window.release()  
+        if future.exception():  
+            logging.error(f"Unexpected error while downloading: {future.exception()}")  
+
+    with auth.attach(requests.Session()) as session:  # HTTP session reuse implemented here; auth keeps its token current  
+        # Size the connection pool to the worker count so threads beyond ten do not queue on the default pool  
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections or thread_count)  
+        session.mount('https://', adapter)  
+        session.mount('http://', adapter)  
+
+        logging.info(f"Downloading with {thread_count} threads (window: {max(batch_size, thread_count)} records, schedule: {schedule})...")  
+        with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:  
+            for record in schedule_records(results, schedule, batch_size):  
+                window.acquire()  
+                metadata_writer.register(record)  
+                future = executor.submit(worker, (  
+                    record, output_directory, sf, filename_pattern,  
+                    metadata_field_indexes, progress, projection,  
+                    session, salesforce_object, metadata_writer, chunk_size,  
+                    checkpoint, resume, throttle, dedup, prior_checkpoint, ranged, sink, auth  
+                ))  
+                future.add_done_callback(release_slot)  
+
+        print("\nDownload process completed successfully.")  
+
+
+async def _fetch_files_async(sf, results, output_directory, filename_pattern, metadata_field_indexes, batch_size, projection, salesforce_object, metadata_writer, progress, chunk_size, checkpoint, resume, max_connections, max_connections_per_host, keepalive_timeout, schedule, throttle, dedup, prior_checkpoint, ranged, sink, auth):  
+    loop = asyncio.get_running_loop()  
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections_per_host, keepalive_timeout=keepalive_timeout)  
+    # Per-read limits like the threaded engine's timeout=600; a total limit would fail every file that streams for over 10 minutes  
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=600, sock_read=600)  
+    window = asyncio.Semaphore(max(batch_size, max_connections))  
+    pending = set()  
+    # Records are handed over from the (blocking) record stream in small chunks to keep the event loop free  
+    chunks = split_into_batches(schedule_records(results, schedule, batch_size), 256)  
+
+    def release_slot(task):  
+        pending.discard(task)  
+        window.release()  
+        if not task.cancelled() and task.exception():  
+            logging.error(f"Unexpected error while downloading: {task.exception()}")  
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:  
+        auth.attach(session)  
+        logging.info(f"Downloading with up to {max_connections} connections (window: {max(batch_size, max_connections)} records, schedule: {schedule})...")  
+        while True:  
+            chunk = await loop.run_in_executor(None, next, chunks, None)  
+            if chunk is None:  
+                break  
+            for record in chunk:  
+                await window.acquire()  
+                metadata_writer.register(record)  
+                task = asyncio.create_task(download_file_async((  
+                    record, output_directory, sf, filename_pattern,  
+                    metadata_field_indexes, progress, projection,  
+                    session, salesforce_object, metadata_writer, chunk_size,  
+                    checkpoint, resume, throttle, dedup, prior_checkpoint, ranged, sink, auth  
+                )))  
+                pending.add(task)  
+                task.add_done_callback(release_slot)  
+        if pending:  
+            await asyncio.wait(pending)  
+
+
+def fetch_files_async(sf, results, output_directory, filename_pattern, metadata_field_indexes, batch_size, projection, salesforce_object, metadata_writer, progress, chunk_size=1048576, checkpoint=None, resume=False, max_connections=100, max_connections_per_host=None, keepalive_timeout=30, schedule='fifo', throttle=None, dedup=None, prior_checkpoint=None, profiler=None, ranged=None, sink=LOCAL_SINK, auth=None):  
+    """  
+    asyncio/aiohttp engine (--engine async). Runs downloads as concurrent in-flight requests on  
+    one event loop instead of one OS thread per request; concurrency is bounded by the connector's  
+    total and per-host connection limits, and a new download starts as soon as any finishes.  
+    With a profiler, the whole event loop (every download_file_async) is profiled as one call.  
+    """  
+    run = profiler.wrap(asyncio.run) if profiler else asyncio.run  
+    run(_fetch_files_async(  
+        sf, results, output_directory, filename_pattern, metadata_field_indexes, batch_size,  
+        projection, salesforce_object, metadata_writer, progress, chunk_size, checkpoint, resume,  
+        max_connections, max_connections_per_host or max_connections, keepalive_timeout, schedule,  
+        throttle or RequestThrottle(max_connections), dedup, prior_checkpoint, ranged, sink, auth or SessionManager(sf)  
+    ))  
+    print("\nDownload process completed successfully.")  
+
+
+
+def validate_query(query):  
+    """  
+    Parses the SOQL field list and target object and checks the fields required for file creation.  
+    Exits with an error if the query cannot be exported.  
+
+    Returns:  
+        tuple: (field_list, salesforce_object)  
+    """  
+    field_list = extract_fields_from_soql(query)  
+  
+    # Identify Salesforce object from SOQL query (must happen here before filtering)  
+    soql_object_match = re.search(r'FROM\s+(\w+)', query, re.IGNORECASE)  
+    if not soql_object_match:  
+        logging.error("Unable to parse Salesforce object from SOQL query.")  
+        exit(1)  
+  
+    salesforce_object = soql_object_match.group(1).lower()  
+  
+    # Required fields validation (only depends on the SOQL, so it runs before any record is fetched)  
+    required_fields = []  
+    if salesforce_object == 'attachment':  
+        required_fields = ['Body', 'BodyLength', 'ContentType']  
+    elif salesforce_object in ['contentdocument', 'contentversion', 'contentdocumentlink']:  
+        required_fields = ['VersionData']  
+    else:  
+        logging.error(f"Unsupported Salesforce object: {salesforce_object}.")  
+        exit(1)  
+  
+    missing_fields = []  
+    for req_field in required_fields:  
+        if not any(f.split('.')[-1] == req_field for f in field_list):  
+            missing_fields.append(req_field)  
+  
+    if missing_fields:  
+        logging.error(f"SOQL query missing required fields for {salesforce_object}: {missing_fields}")  
+        exit(1)  
+  
+    return field_list, salesforce_object  
+
+
+def shard_suffixed(path, shard_index):  
+    """Inserts '.shardK' before the extension of path (unchanged when not sharded)."""  
+    if shard_index is None:  
+        return path  
+    root, extension = os.path.splitext(path)  
+    return f"{root}.shard{shard_index}{extension}"  
+
+
+# Id compared with the [RecordFiltering] list per queried object: (record field paths, in order of preference; field filtered in SOQL)  
+ID_FILTER_FIELDS = {  
+    'attachment': (['Id'], 'Id'),  
+    'contentversion': (['Id'], 'Id'),  
+    'contentdocument': (['LatestPublishedVersion.Id', 'LatestPublishedVersionId'], 'LatestPublishedVersionId'),  
+    'contentdocumentlink': (['ContentDocument.LatestPublishedVersionId', 'ContentDocument.LatestPublishedVersion.Id'], 'ContentDocument.LatestPublishedVersionId'),  
+}  
+
+
+def build_id_filter_queries(query, soql_id_field, ids, chunk_size):  
+    """Returns one query per chunk_size Ids, each ANDing soql_id_field IN (...) into the WHERE clause of query."""  
+    quoted = ("'" + record_id.replace('\\', '\\\\').replace("'", "\\'") + "'" for record_id in ids)  
+    return [add_soql_condition(query, f"{soql_id_field} IN ({', '.join(chunk)})") for chunk in split_into_batches(quoted, max(chunk_size, 1))]  
+
+
+def create_sink(kind, config, output_directory, shard_index=None, max_connections=10):  
+    """Builds the output sink chosen with --sink from the [salesforce] ini settings."""  
+    if kind in ('zip', 'tar'):  
+        return ArchiveSink(  
+            output_directory, kind, shard_index,  
+            shard_size=config.getint('salesforce', 'archive_shard_size', fallback=4294967296),  
+            spool_size=config.getint('salesforce', 'archive_spool_size', fallback=16777216)  
+        )  
+    if kind == 's3':  
+        return S3Sink(  
+            output_directory, config.get('salesforce', 's3_bucket'),  
+            prefix=config.get('salesforce', 's3_prefix', fallback=''),  
+            endpoint_url=config.get('salesforce', 's3_endpoint_url', fallback=None),  
+            region=config.get('salesforce', 's3_region', fallback=None),  
+            access_key=config.get('salesforce', 's3_access_key', fallback=None),  
+            secret_key=config.get('salesforce', 's3_secret_key', fallback=None),  
+            part_size=config.getint('salesforce', 's3_part_size', fallback=8388608),  
+            max_connections=max_connections  
+        )  
+    return LOCAL_SINK  
+
+
+def run_export(sf, args, config, query, results_path, checkpoint_path, shard_index=None, auth=None, progress=None):  
+    """  
+    Runs one export: streams the query, downloads every file into output_dir and writes the  
+    metadata CSV and checkpoint store at the given paths. A sharded run calls this once per shard.  
+    auth (a SessionManager) renews the session when it expires; without it, sf's session is used as-is.  
+    progress (a ProgressTracker) lets the caller read the run's counters afterwards; a new one is used by default.  
+    """  
+    label = f"[Shard {shard_index}] " if shard_index is not None else ''  
+    auth = auth or SessionManager(sf)  
+    output_directory = config['salesforce']['output_dir']  
+    batch_size = int(config['salesforce']['batch_size'])  
+    chunk_size = args.chunksize or config.getint('salesforce', 'chunk_size', fallback=1048576)  
+    queue_size = config.getint('salesforce', 'queue_size', fallback=10000)  
+    max_connections = config.getint('salesforce', 'max_connections', fallback=args.threadcount)  
+    max_connections_per_host = config.getint('salesforce', 'max_connections_per_host', fallback=max_connections)  
+    keepalive_timeout = config.getfloat('salesforce', 'keepalive_timeout', fallback=30)  
+    throttle = RequestThrottle(  
+        max_concurrency=max_connections if args.engine == 'async' else args.threadcount,  
+        max_attempts=config.getint('salesforce', 'max_retries', fallback=5),  
+        base_delay=config.getfloat('salesforce', 'retry_base_delay', fallback=1.0),  
+        max_delay=config.getfloat('salesforce', 'retry_max_delay', fallback=60.0),  
+        breaker_threshold=config.getint('salesforce', 'circuit_breaker_threshold', fallback=10),  
+        breaker_cooldown=config.getfloat('salesforce', 'circuit_breaker_cooldown', fallback=30.0),  
+        adaptive=config.getboolean('salesforce', 'adaptive_concurrency', fallback=True),  
+        min_concurrency=config.getint('salesforce', 'min_concurrency', fallback=1)  
+    )  
+  
+    field_list, salesforce_object = validate_query(query)  
+    metadata_field_indexes = [int(i.strip()) for i in args.metadata.split(',')]  
+  
+    metadata_header = [field_list[idx - 1] for idx in metadata_field_indexes] + ['FilePath', 'XLS_Link_FilePath', 'Status', 'Illegal_Chars_Stripped']  
+  
+    # ---- START OF ROBUST ID FILTERING LOGIC ----  
+    csv_id_filepath = config.get('RecordFiltering', 'Attachments_list_CSV_filepath', fallback=None)  
+    include_or_exclude = config.get('RecordFiltering', 'AttachID_list_Incl_or_Excl', fallback='Include').strip().lower()  
+    record_filter = None  
+    sf_id_field = None  
+    id_index = None  
+    queries = query  
+  
+    if csv_id_filepath:  
+        if salesforce_object not in ID_FILTER_FIELDS:  
+            logging.error(f"Unsupported Salesforce object for ID filtering: {salesforce_object}.")  
+            exit(1)  
+        try:  
+            id_index = IdIndex(csv_id_filepath, config.getint('RecordFiltering', 'id_filter_memory_limit', fallback=1000000), output_directory)  
+        except Exception as e:  
+            logging.error(f"Failed to load IDs from CSV: {e}")  
+            exit(1)  
+
+        # The Id field compared with the list depends on the object (and on which form the SOQL selects)  
+        record_id_fields, soql_id_field = ID_FILTER_FIELDS[salesforce_object]  
+        selected = {field.lower() for field in field_list}  
+        sf_id_field = next((field for field in record_id_fields if field.lower() in selected), record_id_fields[0])  
+        chunk_size = config.getint('RecordFiltering', 'id_filter_chunk_size', fallback=3000 if args.queryapi == 'bulk' else 300)  
+        pushdown_limit = config.getint('RecordFiltering', 'id_filter_pushdown_limit', fallback=20000)  
+
+        # A LIMIT/OFFSET would be applied to every chunk query, so such queries are filtered as they stream in  
+        if include_or_exclude != 'exclude' and len(id_index) <= pushdown_limit and not has_row_limit(query):  
+            # Short include lists are pushed into the SOQL as Id IN (...) chunks, so only matching records are fetched  
+            queries = build_id_filter_queries(query, soql_id_field, id_index, chunk_size)  
+            logging.info(f"Including only IDs from CSV: {len(queries)} queries of up to {chunk_size} IDs on {soql_id_field}.")  
+        else:  
+            # Records are filtered as they stream in, after projection, so the ID field is one precompiled lookup  
+            if sf_id_field.lower() not in selected:  
+                logging.error(f"ID filtering needs {' or '.join(record_id_fields)} in the SOQL for {salesforce_object}.")  
+                exit(1)  
+            if include_or_exclude == 'exclude':  
+                logging.info("Excluding IDs from CSV.")  
+                record_filter = lambda rec: rec.get(sf_id_field) not in id_index  
+            else:  # default to include  
+                reason = 'the SOQL has LIMIT or OFFSET' if has_row_limit(query) else 'above id_filter_pushdown_limit'  
+                logging.info(f"Including only IDs from CSV ({len(id_index)} IDs, {reason}: matched as records stream in).")  
+                record_filter = lambda rec: rec.get(sf_id_field) in id_index  
+    # ---- END OF ROBUST ID FILTERING LOGIC ----  
+  
+    # Field paths are compiled once; each record is reduced to a compact row as it arrives  
+    projection = RecordProjection(field_list, salesforce_object, extra_paths=[sf_id_field] if sf_id_field else ())  
+  
+    # Execute SOQL query on a background producer; downloads start as soon as the first page arrives  
+    logging.info('Executing SOQL query to retrieve files...')  
+    if progress is None:  
+        progress = ProgressTracker(label)  
+    parallel_queries = config.getint('RecordFiltering', 'id_filter_parallel_queries', fallback=4)  
+    if args.queryapi == 'bulk':  
+        logging.info('Using Bulk API 2.0 for the query.')  
+        records = BulkRecordStream(sf, queries, progress, record_filter=record_filter, max_queued=queue_size, throttle=throttle, projection=projection,  
+                                   parallel_queries=parallel_queries, auth=auth, page_size=config.getint('salesforce', 'bulk_page_size', fallback=50000)).start()  
+    else:  
+        records = RecordStream(sf, queries, progress, record_filter=record_filter, max_queued=queue_size, throttle=throttle, projection=projection,  
+                               parallel_queries=parallel_queries, auth=auth).start()  
+    progress.watch(records.queue, throttle)  
+    records.ready.wait()  
+    if records.error:  
+        logging.error(f"SOQL query failed: {records.error}")  
+        exit(1)  
+    logging.info(f"Query reports {records.total_size} records.")  
+  
+    if records.total_size == 0:  
+        logging.info("No records found. Exiting.")  
+        # Still write the header-only files_metadata.csv, e.g. the manifest of an empty shard for --mergeshards  
+        MetadataWriter(results_path, metadata_header, projection, metadata_field_indexes).start().close()  
+        if id_index:  
+            id_index.close()  
+        return  
+  
+    # Fetch and download files concurrently, journaling each outcome to the checkpoint store  
+    checkpoint = CheckpointStore(checkpoint_path)  
+    if args.resume:  
+        logging.info(f"Resuming from checkpoint {checkpoint_path}")  
+  
+    # Incremental sync compares each record's Checksum/SystemModstamp with a prior run's checkpoint  
+    prior_checkpoint = None  
+    if args.incremental is not None:  
+        prior_path = args.incremental or checkpoint_path  
+        if not os.path.exists(prior_path):  
+            logging.error(f"Prior checkpoint not found for incremental sync: {prior_path}")  
+            exit(1)  
+        if not any(f in CHECKSUM_FIELD_PATHS + MODSTAMP_FIELD_PATHS for f in field_list):  
+            logging.warning("Incremental sync needs Checksum or SystemModstamp in the SOQL; every file will be downloaded.")  
+        prior_checkpoint = checkpoint if os.path.abspath(prior_path) == os.path.abspath(checkpoint_path) else CheckpointStore(prior_path)  
+        logging.info(f"Incremental sync against {prior_path}")  
+    dedup = DedupIndex(args.dedup) if args.dedup != 'off' else None  
+
+    # Files go to loose paths under output_dir (default), rolling zip/tar shards or an S3-compatible bucket  
+    sink = create_sink(args.sink, config, output_directory, shard_index, max_connections)  
+    if dedup and dedup.mode == 'hardlink' and not sink.supports_links:  
+        logging.info(f"--dedup hardlink is not possible with --sink {args.sink}; repeats will reference the first copy.")  
+        dedup = DedupIndex('reference')  
+
+    # Files of at least range_threshold bytes are fetched as parallel HTTP Range requests  
+    range_threshold = config.getint('salesforce', 'range_threshold', fallback=0)  
+    ranged = RangedDownloadPlan(  
+        range_threshold,  
+        part_size=config.getint('salesforce', 'range_part_size', fallback=67108864),  
+        connections=config.getint('salesforce', 'range_connections', fallback=4)  
+    ) if range_threshold else None  
+    if ranged and not sink.supports_ranges:  
+        logging.warning(f"Ranged downloads need --sink files; large files are downloaded in one stream with --sink {args.sink}.")  
+        ranged = None  
+
+    # Optional instrumentation: Prometheus endpoint, periodic JSON stats file and cProfile  
+    metrics_port = config.getint('salesforce', 'metrics_port', fallback=0)  
+    metrics_server = None  
+    if metrics_port:  
+        metrics_host = config.get('salesforce', 'metrics_host', fallback='127.0.0.1') or '127.0.0.1'  
+        metrics_server = MetricsServer(progress, metrics_port + (shard_index or 0), metrics_host).start()  
+    stats_file = config.get('salesforce', 'stats_file', fallback='')  
+    stats_writer = None  
+    if stats_file:  
+        stats_path = shard_suffixed(os.path.join(output_directory, stats_file), shard_index)  
+        stats_writer = StatsFileWriter(progress, stats_path, config.getfloat('salesforce', 'stats_interval', fallback=10.0)).start()  
+    profiler = DownloadProfiler() if args.profile else None  
+
+    # Finished rows are journaled by a writer thread and merged into the metadata CSV at the end  
+    metadata_writer = MetadataWriter(  
+        results_path, metadata_header, projection, metadata_field_indexes,  
+        fsync_interval=config.getfloat('salesforce', 'metadata_fsync_interval', fallback=5.0)  
+    ).start()  
+    try:  
+        if args.engine == 'async':  
+            fetch_files_async(  
+                sf=sf,  
+                results=records,  
+                output_directory=output_directory,  
+                filename_pattern=args.filenamepattern,  
+                metadata_field_indexes=metadata_field_indexes,  
+                batch_size=batch_size,  
+                projection=projection,  
+                salesforce_object=salesforce_object,  
+                metadata_writer=metadata_writer,  
+                progress=progress,  
+                chunk_size=chunk_size,  
+                checkpoint=checkpoint,  
+                resume=args.resume,  
+                max_connections=max_connections,  
+                max_connections_per_host=max_connections_per_host,  
+                keepalive_timeout=keepalive_timeout,  
+                schedule=args.schedule,  
+                throttle=throttle,  
+                dedup=dedup,  
+                prior_checkpoint=prior_checkpoint,  
+                profiler=profiler,  
+                ranged=ranged,  
+                sink=sink,  
+                auth=auth  
+            )  
+        else:  
+            fetch_files(  
+                sf=sf,  
+                results=records,  
+                output_directory=output_directory,  
+                filename_pattern=args.filenamepattern,  
+                metadata_field_indexes=metadata_field_indexes,  
+                batch_size=batch_size,  
+                thread_count=args.threadcount,  
+                projection=projection,  
+                salesforce_object=salesforce_object,  
+                metadata_writer=metadata_writer,  
+                progress=progress,  
+                chunk_size=chunk_size,  
+                checkpoint=checkpoint,  
+                resume=args.resume,  
+                max_connections=max_connections,  
+                schedule=args.schedule,  
+                throttle=throttle,  
+                dedup=dedup,  
+                prior_checkpoint=prior_checkpoint,  
+                profiler=profiler,  
+                ranged=ranged,  
+                sink=sink,  
+                auth=auth  
+            )  
+    finally:  
+        # Finish the last archive shard, then write the metadata CSV after all downloads (or whatever completed before a failure)  
+        sink.close()  
+        metadata_writer.close()  
+        if id_index:  
+            id_index.close()  
+        checkpoint.close()  
+        if prior_checkpoint and prior_checkpoint is not checkpoint:  
+            prior_checkpoint.close()  
+        if stats_writer:  
+            stats_writer.stop()  
+        if metrics_server:  
+            metrics_server.stop()  
+        if profiler:  
+            profiler.dump(shard_suffixed(args.profile, shard_index))  
+  
+    if records.filtered_out:  
+        logging.info(f"ID filtering removed {records.filtered_out} records.")  
+
+
+# Date field used for --shardby createddate; ContentDocumentLink has no CreatedDate of its own  
+SHARD_DATE_FIELDS = {'contentdocumentlink': 'ContentDocument.CreatedDate'}  
+
+
+def plan_id_shards(sf, query, shard_count):  
+    """  
+    Cuts the query into shard_count equal-sized Id ranges. Only the Ids are read (ordered by Id)  
+    to find the boundaries, which are kept in memory; the records themselves are not.  
+
+    Returns:  
+        list: One extra WHERE condition per shard (None means no restriction).  
+    """  
+    head, where, _ = split_soql(query)  
+    object_name = re.search(r'\bFROM\s+(\w+)', head, re.IGNORECASE).group(1)  
+    id_query = f"SELECT Id FROM {object_name}" + (f" WHERE {where}" if where else '') + " ORDER BY Id"  
+    result = sf.query(id_query)  
+    total = result.get('totalSize', 0)  
+    if total < shard_count:  
+        logging.info(f"Only {total} records; running a single shard.")  
+        return [None]  
+    cut_points = {total * k // shard_count: k for k in range(1, shard_count)}  
+    boundaries = []  
+    position = 0  
+    while True:  
+        for record in result.get('records', []):  
+            if position in cut_points:  
+                boundaries.append(record['Id'])  
+            position += 1  
+        if result.get('done', True):  
+            break  
+        result = sf.query_more(result['nextRecordsUrl'], identifier_is_url=True)  
+  
+    bounds = [None] + boundaries + [None]  
+    conditions = []  
+    for lower, upper in zip(bounds, bounds[1:]):  
+        parts = ([f"Id >= '{lower}'"] if lower else []) + ([f"Id < '{upper}'"] if upper else [])  
+        conditions.append(' AND '.join(parts) or None)  
+    return conditions  
+
+
+def plan_date_shards(sf, query, shard_count, salesforce_object):  
+    """  
+    Cuts the query into shard_count equal CreatedDate windows between the oldest and newest record.  
+    The first and last windows are open-ended so records created meanwhile are not lost.  
+
+    Returns:  
+        list: One extra WHERE condition per shard (None means no restriction).  
+    """  
+    date_field = SHARD_DATE_FIELDS.get(salesforce_object, 'CreatedDate')  
+    head, where, _ = split_soql(query)  
+    object_name = re.search(r'\bFROM\s+(\w+)', head, re.IGNORECASE).group(1)  
+    range_query = f"SELECT MIN({date_field}) minDate, MAX({date_field}) maxDate FROM {object_name}" + (f" WHERE {where}" if where else '')  
+    row = sf.query(range_query)['records'][0]  
+    if not row.get('minDate'):  
+        logging.info("No records; running a single shard.")  
+        return [None]  
+    start = datetime.strptime(row['minDate'], '%Y-%m-%dT%H:%M:%S.%f%z')  
+    end = datetime.strptime(row['maxDate'], '%Y-%m-%dT%H:%M:%S.%f%z')  
+    step = (end - start) / shard_count  
+    cuts = [(start + step * k).astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ') for k in range(1, shard_count)]  
+    bounds = [None] + cuts + [None]  
+    conditions = []  
+    for lower, upper in zip(bounds, bounds[1:]):  
+        parts = ([f"{date_field} >= {lower}"] if lower else []) + ([f"{date_field} < {upper}"] if upper else [])  
+        conditions.append(' AND '.join(parts) or None)  
+    return conditions  
+
+
+def read_shard_plan(output_directory):  
+    """Returns the shard_plan.json of output_dir as a dict, or None if there is none."""  
+    plan_path = os.path.join(output_directory, 'shard_plan.json')  
+    if not os.path.exists(plan_path):  
+        return None  
+    with open(plan_path, 'r', encoding='utf-8') as f_plan:  
+        return json.load(f_plan)  
+
+
+def load_or_create_shard_plan(sf, query, shard_count, shard_by, output_directory):  
+    """  
+    Returns the per-shard queries. The plan is stored as shard_plan.json in output_dir so every  
+    process or host working on the same shared directory uses identical shard boundaries.  
+    """  
+    plan_path = os.path.join(output_directory, 'shard_plan.json')  
+    plan = read_shard_plan(output_directory)  
+    if plan:  
+        if plan.get('query') == query and plan.get('shard_count') == shard_count and plan.get('shard_by') == shard_by:  
+            logging.info(f"Using existing shard plan {plan_path}")  
+            return plan['shard_queries']  
+  
+    logging.info(f"Planning {shard_count} shards by {shard_by}...")  
+    _, salesforce_object = validate_query(query)  
+    if shard_by == 'createddate':  
+        conditions = plan_date_shards(sf, query, shard_count, salesforce_object)  
+    else:  
+        conditions = plan_id_shards(sf, query, shard_count)  
+    shard_queries = [add_soql_condition(query, condition) if condition else query for condition in conditions]  
+  
+    # Written aside and renamed into place, so hosts started with --shardindex never read a half-written plan  
+    temp_path = f"{plan_path}.{os.getpid()}.tmp"  
+    with open(temp_path, 'w', encoding='utf-8') as f_plan:  
+        json.dump({'query': query, 'shard_count': shard_count, 'shard_by': shard_by, 'shard_queries': shard_queries}, f_plan, indent=2)  
+    os.replace(temp_path, plan_path)  
+    for index, shard_query in enumerate(shard_queries):  
+        logging.debug(f"Shard {index}: {shard_query}")  
+    return shard_queries  
+
+
+def shard_paths(output_directory, shard_index):  
+    """Returns (results_path, checkpoint_path) of one shard's own manifest and checkpoint store."""  
+    return (os.path.join(output_directory, f'files_metadata.shard{shard_index}.csv'),  
+            os.path.join(output_directory, f'download_checkpoint.shard{shard_index}.db'))  
+
+
+def run_shard_process(shard_index, shard_query, args, auth):  
+    """  
+    Process entry point for one local shard. Reuses the parent's session instead of logging in again;  
+    renewals go through the shared token cache, so one login serves every shard.  
+    """  
+    config = configparser.ConfigParser()  
+    config.read('download.ini')  
+    logging.basicConfig(format=f'%(asctime)s %(levelname)s [Shard {shard_index}] %(message)s', level=logging.getLevelName(config['salesforce']['loglevel']))  
+    results_path, checkpoint_path = shard_paths(config['salesforce']['output_dir'], shard_index)  
+    run_export(auth.sf, args, config, shard_query, results_path, checkpoint_path, shard_index=shard_index, auth=auth)  
+
+
+def run_sharded_export(auth, args, shard_queries, output_directory):  
+    """  
+    Runs every shard in its own process so sanitizing, hashing and disk writes use all cores.  
+
+    Returns:  
+        list: Indexes of the shards that failed.  
+    """  
+    logging.info(f"Running {len(shard_queries)} shards in parallel processes...")  
+    context = multiprocessing.get_context('spawn')  
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(shard_queries), mp_context=context) as executor:  
+        futures = {  
+            executor.submit(run_shard_process, index, shard_query, args, auth): index  
+            for index, shard_query in enumerate(shard_queries)  
+        }  
+        failed = []  
+        for future in concurrent.futures.as_completed(futures):  
+            index = futures[future]  
+            try:  
+                future.result()  
+                logging.info(f"Shard {index} finished.")  
+            except BaseException as e:  
+                logging.error(f"Shard {index} failed: {e!r}")  
+                failed.append(index)  
+    return sorted(failed)  
+
+
+def merge_shard_manifests(output_directory, results_path, shard_count):  
+    """  
+    Concatenates files_metadata.shard0..N-1.csv (in shard order, one header) into the final  
+    files_metadata.csv. Manifests of higher shard numbers left by an earlier run are ignored;  
+    if any of the N is missing, nothing is merged and the run exits with an error.  
+    """  
+    shard_files = [shard_paths(output_directory, index)[0] for index in range(shard_count)]  
+    missing = [path for path in shard_files if not os.path.exists(path)]  
+    if missing:  
+        logging.error(f"Cannot merge: missing shard manifests {', '.join(os.path.basename(path) for path in missing)}.")  
+        exit(1)  
+    rows = 0  
+    with open(results_path, 'w', encoding='utf-8', newline='') as f_out:  
+        writer = csv.writer(f_out)  
+        for shard_number, shard_file in enumerate(shard_files):  
+            with open(shard_file, 'r', encoding='utf-8', newline='') as f_in:  
+                reader = csv.reader(f_in)  
+                header = next(reader, None)  
+                if shard_number == 0 and header:  
+                    writer.writerow(header)  
+                for row in reader:  
+                    writer.writerow(row)  
+                    rows += 1  
+    logging.info(f"Merged {len(shard_files)} shard manifests ({rows} rows) into {results_path}")  
+
+
+def load_login_settings(config):  
+    """  
+    Salesforce login settings (SalesforceLogin keyword arguments) from [salesforce]. With consumer_key  
+    and private_key_file set, the OAuth 2.0 JWT bearer flow is used: no password or security token,  
+    so headless runs never prompt. Otherwise missing credentials are prompted for.  
+    """  
+    username = config.get('salesforce', 'username', fallback=None)  
+    if not username:  
+        username = input("Please enter Salesforce username: ")  
+  
+    is_sandbox = config['salesforce'].getboolean('connect_to_sandbox', False)  
+    domain = config['salesforce'].get('domain', '')  
+    domain = f"{domain}.my" if domain else ('test' if is_sandbox else 'login')  
+  
+    consumer_key = config.get('salesforce', 'consumer_key', fallback=None)  
+    private_key_file = config.get('salesforce', 'private_key_file', fallback=None)  
+    if consumer_key and private_key_file:  
+        return {'username': username, 'consumer_key': consumer_key, 'privatekey_file': private_key_file, 'domain': domain}  
+  
+    password = config.get('salesforce', 'password', fallback=None)  
+    if not password:  
+        password = getpass.getpass("Please enter Salesforce password: ")  
+    token = config.get('salesforce', 'security_token', fallback=None)  
+    if not token:  
+        token = getpass.getpass("Please enter Salesforce security token: ")  
+    return {'username': username, 'password': password, 'security_token': token, 'domain': domain}  
+
+
+def build_arg_parser():  
+    """Command line options of Download.py (also used by Benchmark.py to drive a real export)."""  
+    parser = argparse.ArgumentParser(description='Export Salesforce ContentVersion Files')  
+    
+                        
+    parser.add_argument('-q', '--query', required=True, help='SOQL query to select files.  You can query from ContentDocument, ContentDocumentLink, ContentVersion or Attachment object.  All selected fields included in SOQL can be ported to -f and/or -m arguments for flexibility.  Manditory Include ContentVersion.VersionData or Attachment.Body for File Creation.')  
+    parser.add_argument('-f', '--filenamepattern', default='{1}\{2}.{3}',  
+                        help='Filename pattern using indexed SOQL fields, default: {1}\{2}.{3}  Be Aware that if you dont specify the ID Column in this pattern, you may end up having duplicate filenames overwrite each other which will make it seem that not all files are extracted.')  
+    parser.add_argument('-m', '--metadata', default='1,2,3' , required=True,
+                        help='Comma-separated indexed fields for metadata CSV output, e.g. "1,2,3"')  
+    parser.add_argument('-t', '--threadcount', type=int, default=10,  
+                        help='Number of concurrent threads (default: 10)')  
+    parser.add_argument('-c', '--chunksize', type=int, default=None,  
+                        help='Bytes read per chunk while streaming each file to disk (default: chunk_size from ini, else 1048576)')  
+    parser.add_argument('-r', '--resume', action='store_true',  
+                        help='Skip records a previous run already downloaded (Success in the checkpoint and on-disk size matching BodyLength/ContentSize)')  
+    parser.add_argument('-e', '--engine', choices=['threads', 'async'], default='threads',  
+                        help='Download engine: "threads" (ThreadPoolExecutor + requests, default) or "async" (asyncio + aiohttp, many in-flight requests without one OS thread each)')  
+    parser.add_argument('-s', '--schedule', choices=['fifo', 'largest-first', 'interleave'], default='fifo',  
+                        help='Download order within a batch_size lookahead window, based on BodyLength/ContentSize: "fifo" (query order, default), "largest-first" or "interleave" (alternate largest and smallest)')  
+    parser.add_argument('--dedup', choices=['off', 'hardlink', 'reference'], default='off',  
+                        help='Download repeated content (same VersionData URL, or same ContentVersion Checksum) once: "hardlink" links the copies to the first file, "reference" only points their metadata row at it (default: off)')  
+    parser.add_argument('--incremental', nargs='?', const='', default=None, metavar='PRIOR_CHECKPOINT',  
+                        help='Only download new or changed versions, comparing Checksum/SystemModstamp against a prior run\'s download_checkpoint.db (default: the one in output_dir)')  
+    parser.add_argument('--shards', type=int, default=1,  
+                        help='Split the export into N shards by Id range or CreatedDate window, each run by its own process with its own manifest (default: 1, no sharding)')  
+    parser.add_argument('--shardby', choices=['id', 'createddate'], default='id',  
+                        help='How shards are cut: "id" (equal-sized Id ranges, default) or "createddate" (equal CreatedDate windows)')  
+    parser.add_argument('--shardindex', type=int, default=None,  
+                        help='Run only this shard (0-based) in the current process, e.g. one shard per host against a shared output_dir')  
+    parser.add_argument('--sink', choices=['files', 'zip', 'tar', 's3'], default='files',  
+                        help='Where files are written: "files" (one file per record under output_dir, default), "zip" or "tar" (rolling archive shards in output_dir) or "s3" (S3-compatible bucket from the ini, multipart upload, needs boto3)')  
+    parser.add_argument('--queryapi', choices=['rest', 'bulk'], default='rest',  
+                        help='API used to run the SOQL query: "rest" (query/queryMore, default) or "bulk" (Bulk API 2.0 job streamed as CSV, for millions of records; no TYPEOF)')  
+    parser.add_argument('--profile', default=None, metavar='PROFILE_FILE',  
+                        help='Run download_file under cProfile and write the merged stats to PROFILE_FILE (one file per shard); inspect with python -m pstats')  
+    parser.add_argument('--mergeshards', action='store_true',  
+                        help='Merge the manifests of the shards in shard_plan.json into files_metadata.csv and exit')  
+    return parser  
+
+
+def main():  
+    args = build_arg_parser().parse_args()  
+  
+    config = configparser.ConfigParser()  
+    config.read('download.ini')  
+  
+    loglevel = logging.getLevelName(config['salesforce']['loglevel'])  
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=loglevel)  
+  
+    if args.engine == 'async' and aiohttp is None:  
+        logging.error("--engine async requires the aiohttp package (pip install aiohttp).")  
+        exit(1)  
+    if args.sink == 's3' and boto3 is None:  
+        logging.error("--sink s3 requires the boto3 package (pip install boto3).")  
+        exit(1)  
+    if args.sink == 's3' and not config.get('salesforce', 's3_bucket', fallback=''):  
+        logging.error("--sink s3 requires s3_bucket in download.ini.")  
+        exit(1)  
+  
+    output_directory = config['salesforce']['output_dir']  
+    os.makedirs(output_directory, exist_ok=True)  
+    results_path = os.path.join(output_directory, 'files_metadata.csv')  
+    checkpoint_path = os.path.join(output_directory, 'download_checkpoint.db')  
+  
+    if args.mergeshards:  
+        plan = read_shard_plan(output_directory)  
+        if not plan:  
+            logging.error(f"No shard_plan.json in {output_directory}; nothing to merge.")  
+            exit(1)  
+        merge_shard_manifests(output_directory, results_path, len(plan['shard_queries']))  
+        return  
+  
+    # Validate the query before logging in or spawning any shard  
+    validate_query(args.query)  
+    if args.shards > 1 and has_row_limit(args.query):  
+        logging.error("--shards cannot split a query with LIMIT or OFFSET: each shard would apply it again. Remove it or run a single export.")  
+        exit(1)  
+    if args.queryapi == 'bulk':  
+        try:  
+            build_bulk_query(args.query)  
+        except ValueError as e:  
+            logging.error(str(e))  
+            exit(1)  
+  
+    # Salesforce credentials setup; the session is renewed with the same settings when it expires  
+    auth = SessionManager(  
+        login=load_login_settings(config),  
+        cache_path=os.path.join(output_directory, 'session_cache.json') if args.shards > 1 else None,  
+        max_age=config.getfloat('salesforce', 'session_max_age', fallback=5400)  
+    )  
+  
+    logging.info('Connecting to Salesforce...')  
+    sf = auth.connect()  
+    logging.info('Connected successfully.')  
+  
+    try:  
+        if args.shards <= 1:  
+            run_export(sf, args, config, args.query, results_path, checkpoint_path, auth=auth)  
+            return  
+  
+        shard_queries = load_or_create_shard_plan(sf, args.query, args.shards, args.shardby, output_directory)  
+        if args.shardindex is not None:  
+            if not 0 <= args.shardindex < len(shard_queries):  
+                logging.error(f"--shardindex must be between 0 and {len(shard_queries) - 1}.")  
+                exit(1)  
+            shard_results_path, shard_checkpoint_path = shard_paths(output_directory, args.shardindex)  
+            run_export(sf, args, config, shard_queries[args.shardindex], shard_results_path, shard_checkpoint_path, shard_index=args.shardindex, auth=auth)  
+        else:  
+            failed = run_sharded_export(auth, args, shard_queries, output_directory)  
+            if failed:  
+                logging.error(f"Shards {', '.join(map(str, failed))} failed; {os.path.basename(results_path)} was not merged. "  
+                              f"Rerun with --resume (and --mergeshards once every shard is complete).")  
+                exit(1)  
+            merge_shard_manifests(output_directory, results_path, len(shard_queries))  
+    finally:  
+        auth.close()  
   
 if __name__ == "__main__":  
     main()  
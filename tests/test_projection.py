@@ -0,0 +1,80 @@
+"""
+RecordProjection must read the same values as the raw REST record dict, whatever casing the SOQL uses.
+Run with: python -m pytest tests   (or: python -m unittest discover tests)
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Download  # noqa: E402
+
+
+CONTENT_VERSION = {
+    'attributes': {'type': 'ContentVersion', 'url': '/services/data/v59.0/sobjects/ContentVersion/068000000000001AAA'},
+    'Id': '068000000000001AAA',
+    'Title': 'Quarterly Report',
+    'FileExtension': 'pdf',
+    'ContentSize': 1234,
+    'Checksum': 'd41d8cd98f00b204e9800998ecf8427e',
+    'VersionData': '/services/data/v59.0/sobjects/ContentVersion/068000000000001AAA/VersionData',
+}
+
+ATTACHMENT = {
+    'attributes': {'type': 'Attachment', 'url': '/services/data/v59.0/sobjects/Attachment/00P000000000001AAA'},
+    'Id': '00P000000000001AAA',
+    'Name': 'contract.docx',
+    'ContentType': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'BodyLength': 5678,
+    'Parent': {'attributes': {'type': 'Account'}, 'Name': 'Acme'},
+    'Body': '/services/data/v59.0/sobjects/Attachment/00P000000000001AAA/Body',
+}
+
+
+class RecordProjectionTest(unittest.TestCase):
+
+    def assert_matches_raw(self, soql, salesforce_object, record, used_paths):
+        field_list = Download.extract_fields_from_soql(soql)
+        projection = Download.RecordProjection(field_list, salesforce_object)
+        compact = projection.project(record)
+        for path in used_paths:
+            self.assertEqual(compact.get(path), Download.get_nested_field(record, path), f'{path} of {soql}')
+        self.assertEqual(list(projection.field_values(compact)), [Download.get_nested_field(record, path) for path in field_list])
+        return compact
+
+    def test_api_casing(self):
+        compact = self.assert_matches_raw('SELECT Id, Title, FileExtension, ContentSize, VersionData FROM ContentVersion', 'contentversion',
+                                          CONTENT_VERSION, ['Id', 'Title', 'FileExtension', 'ContentSize', 'Checksum', 'VersionData'])
+        self.assertEqual(compact.get('Id'), '068000000000001AAA')
+
+    def test_lowercase_soql_fields(self):
+        compact = self.assert_matches_raw('SELECT id, title, FileExtension, ContentSize, VersionData FROM ContentVersion', 'contentversion',
+                                          CONTENT_VERSION, ['Id', 'Title', 'FileExtension', 'ContentSize', 'Checksum', 'VersionData'])
+        self.assertEqual(compact.get('Id'), '068000000000001AAA')
+        self.assertEqual(compact.get('Title'), 'Quarterly Report')
+        self.assertEqual(Download.get_expected_size(compact), 1234)
+
+    def test_mixed_casing_attachment(self):
+        compact = self.assert_matches_raw('SELECT ID, NAME, contenttype, BodyLength, Parent.Name, body FROM Attachment', 'attachment',
+                                          ATTACHMENT, ['Id', 'Name', 'ContentType', 'BodyLength', 'Body', 'Parent.Name'])
+        self.assertEqual(compact.get('Id'), '00P000000000001AAA')
+        self.assertEqual(compact.get('Body'), ATTACHMENT['Body'])
+
+    def test_distinct_ids_per_record(self):
+        projection = Download.RecordProjection(['id', 'title', 'VersionData'], 'contentversion')
+        ids = {projection.project(dict(CONTENT_VERSION, Id=f'068{index:015d}')).get('Id') for index in range(50)}
+        self.assertEqual(len(ids), 50)
+        self.assertNotIn(None, ids)
+
+    def test_bulk_row_with_lowercase_header(self):
+        projection = Download.RecordProjection(['id', 'title', 'FileExtension'], 'contentversion')
+        build = projection.projector(Download.RecordLayout(['id', 'title', 'FileExtension', 'VersionData']))
+        compact = build(['068000000000001AAA', 'Quarterly Report', 'pdf', '/VersionData'])
+        self.assertEqual(compact.get('Id'), '068000000000001AAA')
+        self.assertEqual(compact.get('Title'), 'Quarterly Report')
+        self.assertEqual(compact.get('VersionData'), '/VersionData')
+
+
+if __name__ == '__main__':
+    unittest.main()
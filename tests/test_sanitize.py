@@ -0,0 +1,99 @@
+"""
+sanitize_with_mask must return exactly what the original per-character implementation returned.
+Run with: python -m pytest tests   (or: python -m unittest discover tests)
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Download  # noqa: E402
+
+
+def reference_sanitize_with_mask(original_str, replace_with=' '):
+    """The per-character sanitize_with_mask that Download.py shipped before it was rewritten with regexes."""
+    sanitized = []
+    illegal_mask = []
+    for c in original_str:
+        if Download.ILLEGAL_CHARS_PATTERN.match(c):
+            sanitized.append(replace_with)
+            illegal_mask.append(c)
+        else:
+            sanitized.append(c)
+            illegal_mask.append(' ')
+    return ''.join(sanitized), ''.join(illegal_mask)
+
+
+CONTROL_CHARS = [chr(code) for code in range(0x20)]
+RESERVED_CHARS = list('<>:"/\\|?*')
+LEGAL_ASCII = list('abcXYZ019 .-_()[]{}\'`~!@#$%^&=+,;') + ['\x7f']
+NON_ASCII = ['\x80', '\xa0', 'é', 'ß', 'Ω', '中', '文', '​', '﻿', '￿', '😀', '\U0010ffff']
+SURROGATES = ['\ud800', '\udbff', '\udc00', '\udfff']
+ALPHABET = CONTROL_CHARS + RESERVED_CHARS + LEGAL_ASCII + NON_ASCII + SURROGATES
+
+REPLACEMENTS = [' ', '', '_', '-', '\\', '\\\\', '\\1', '\\g<0>', '\\n', '$', 'ab']
+
+FIXED_CASES = [
+    '',
+    'Quarterly Report 2024',
+    'Contract v2 (final).pdf',
+    'a<b>c:d"e/f\\g|h?i*j',
+    '\x00\x01\x1f\t\n\r',
+    'Résumé – naïve café',
+    '中文文件名',
+    'emoji 😀 name',
+    'lone \ud800 surrogate \udfff',
+    '\\1\\g<0>',
+    'DEL\x7fchar',
+    'trailing space ',
+]
+
+
+class SanitizeWithMaskTest(unittest.TestCase):
+
+    def assert_matches_reference(self, original_str, replace_with):
+        expected = reference_sanitize_with_mask(original_str, replace_with)
+        self.assertEqual(Download.sanitize_with_mask(original_str, replace_with), expected,
+                         f'{original_str!r} with replace_with={replace_with!r}')
+
+    def test_fixed_cases(self):
+        for replace_with in REPLACEMENTS:
+            for original_str in FIXED_CASES:
+                self.assert_matches_reference(original_str, replace_with)
+
+    def test_every_character_class_alone(self):
+        for replace_with in REPLACEMENTS:
+            for c in ALPHABET:
+                self.assert_matches_reference(c, replace_with)
+                self.assert_matches_reference(f'a{c}b', replace_with)
+
+    def test_random_strings(self):
+        rng = random.Random(20240601)
+        for _ in range(20000):
+            original_str = ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 40)))
+            self.assert_matches_reference(original_str, rng.choice(REPLACEMENTS))
+
+    def test_mostly_clean_strings(self):
+        rng = random.Random(7)
+        for _ in range(5000):
+            chars = [rng.choice(LEGAL_ASCII) for _ in range(rng.randint(1, 60))]
+            if rng.random() < 0.3:
+                chars[rng.randrange(len(chars))] = rng.choice(CONTROL_CHARS + RESERVED_CHARS + NON_ASCII + SURROGATES)
+            self.assert_matches_reference(''.join(chars), rng.choice(REPLACEMENTS))
+
+    def test_default_replacement(self):
+        for original_str in FIXED_CASES:
+            self.assertEqual(Download.sanitize_with_mask(original_str), reference_sanitize_with_mask(original_str))
+
+    def test_without_mask(self):
+        for original_str in FIXED_CASES:
+            for replace_with in REPLACEMENTS:
+                sanitized, illegal_mask = Download.sanitize_with_mask(original_str, replace_with, with_mask=False)
+                self.assertEqual(sanitized, reference_sanitize_with_mask(original_str, replace_with)[0])
+                self.assertIsNone(illegal_mask)
+
+
+if __name__ == '__main__':
+    unittest.main()